@@ -30,9 +30,14 @@ Script that serves as the input script to pyinstaller for compilation of an exec
 
 import os
 import sys
+import multiprocessing
 sys.path.append(os.path.join(os.path.split(__file__)[0], '..'))
 
 from rmexplorer.__main__ import main
 
 
-main(use_resources=True)
+if __name__ == '__main__':
+    # PNG rendering uses a process pool.  In the frozen executable, the child
+    # processes run this script again and must stop here.
+    multiprocessing.freeze_support()
+    main(use_resources=True)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Backups stored as a single archive file
+
+All the members of a backup archive are inside one top-level folder, named
+after the archive. Paths passed to and returned by this module are relative
+to that folder.
+"""
+
+
+import os
+import time
+import tarfile
+import zipfile
+import posixpath
+
+import rmexplorer.constants as constants
+import rmexplorer.inventory as inventory
+
+
+# Archive formats, with the file extension and the tarfile mode (None for zip)
+Formats = {
+    'tar.gz': ('.tar.gz', 'gz'),
+    'tar.xz': ('.tar.xz', 'xz'),
+    'zip': ('.zip', None),
+}
+
+
+def archiveFormat(path):
+    """Returns the archive format of a file from its name, or None"""
+
+    for fmt, (ext, _) in Formats.items():
+        if path.lower().endswith(ext):
+            return fmt
+    if path.lower().endswith('.tgz'):
+        return 'tar.gz'
+
+    return None
+
+
+def _relPath(name):
+    """Strips the top-level folder from the name of an archive member
+
+    Returns None for the top-level folder itself.
+    """
+
+    parts = [part for part in name.split('/') if part]
+    if '..' in parts:
+        raise ValueError('Archive member "%s" points outside of the backup.' % name)
+    if len(parts) < 2:
+        return None
+
+    return '/'.join(parts[1:])
+
+
+class ArchiveWriter():
+    """Writes a backup archive
+
+    The archive is written to a temporary file that only replaces `path` when
+    the writer is closed. Use as a context manager to discard the temporary
+    file if an exception is raised.
+    """
+
+    def __init__(self, path, fmt):
+
+        self._path = path
+        self._partPath = path + '.part'
+        self._fmt = fmt
+        self._topDir = os.path.basename(path)[:-len(Formats[fmt][0])]
+        compression = Formats[fmt][1]
+        if compression is None:
+            self._tar = None
+            self._zip = zipfile.ZipFile(self._partPath, 'w',
+                                        compression=zipfile.ZIP_DEFLATED)
+        else:
+            self._zip = None
+            self._tar = tarfile.open(self._partPath, 'w:%s' % compression)
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+    def _zipInfo(self, name, mtime):
+
+        # Zip files cannot store dates before 1980
+        dateTime = time.localtime(max(mtime, constants.ZipMinTimestamp))[:6]
+        info = zipfile.ZipInfo(name, date_time=dateTime)
+        info.compress_type = zipfile.ZIP_DEFLATED
+
+        return info
+
+
+    def addDir(self, relPath, mtime):
+
+        name = posixpath.join(self._topDir, relPath)
+        if self._tar is not None:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = mtime
+            self._tar.addfile(info)
+        else:
+            info = self._zipInfo(name + '/', mtime)
+            info.external_attr = 0o40755 << 16 | 0x10
+            self._zip.writestr(info, b'')
+
+
+    def addFile(self, relPath, fileObj, size, mtime, progressCallback=None):
+        """Adds a file of `size` bytes read from `fileObj`
+
+        If given, `progressCallback(received)` is called as the data is
+        written.
+        """
+
+        name = posixpath.join(self._topDir, relPath)
+        if self._tar is not None:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mode = 0o644
+            info.mtime = mtime
+            if progressCallback is not None:
+                fileObj = _ProgressReader(fileObj, progressCallback)
+            self._tar.addfile(info, fileObj)
+        else:
+            info = self._zipInfo(name, mtime)
+            info.external_attr = 0o644 << 16
+            received = 0
+            with self._zip.open(info, 'w', force_zip64=True) as f:
+                while True:
+                    chunk = fileObj.read(constants.SSHChunkSize)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progressCallback is not None:
+                        progressCallback(received)
+
+
+    def close(self):
+
+        if self._tar is not None:
+            self._tar.close()
+        else:
+            self._zip.close()
+        os.replace(self._partPath, self._path)
+
+
+    def abort(self):
+
+        try:
+            if self._tar is not None:
+                self._tar.close()
+            else:
+                self._zip.close()
+        finally:
+            os.remove(self._partPath)
+
+
+class _ProgressReader():
+    """File wrapper reporting the number of bytes read"""
+
+    def __init__(self, fileObj, callback):
+
+        self._fileObj = fileObj
+        self._callback = callback
+        self._received = 0
+
+
+    def read(self, size=-1):
+
+        data = self._fileObj.read(size)
+        self._received += len(data)
+        self._callback(self._received)
+
+        return data
+
+
+def listArchive(path):
+    """Lists the files and folders of a backup archive
+
+    Folders are listed before their content, including folders that have no
+    member of their own in the archive.
+    """
+
+    if archiveFormat(path) == 'zip':
+        with zipfile.ZipFile(path) as zf:
+            members = [(info.filename, info.is_dir(), info.file_size,
+                        time.mktime(info.date_time + (0, 0, -1)))
+                       for info in zf.infolist()]
+    else:
+        with tarfile.open(path) as tar:
+            members = [(info.name, info.isdir(), info.size, info.mtime)
+                       for info in tar.getmembers()
+                       if info.isdir() or info.isfile()]
+
+    entries = {}
+    for name, isDir, size, mtime in members:
+        relPath = _relPath(name)
+        if relPath is None:
+            continue
+        # Parent folders are added if the archive has no member for them
+        parent = posixpath.dirname(relPath)
+        while parent and parent not in entries:
+            entries[parent] = inventory.Entry(parent, True, 0, mtime)
+            parent = posixpath.dirname(parent)
+        entries[relPath] = inventory.Entry(relPath, isDir, 0 if isDir else size, mtime)
+
+    return sorted(entries.values(), key=lambda entry: entry.path.count('/'))
+
+
+def iterFiles(path):
+    """Yields the inventory entry and a file object of each file of a backup archive
+
+    Files are read in the order of the archive, which reads compressed tar
+    archives in a single pass. Each file object is only valid until the next
+    one is yielded.
+    """
+
+    if archiveFormat(path) == 'zip':
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                relPath = _relPath(info.filename)
+                if relPath is None or info.is_dir():
+                    continue
+                entry = inventory.Entry(relPath, False, info.file_size,
+                              time.mktime(info.date_time + (0, 0, -1)))
+                with zf.open(info) as f:
+                    yield entry, f
+    else:
+        with tarfile.open(path, 'r|*') as tar:
+            for info in tar:
+                relPath = _relPath(info.name)
+                if relPath is None or not info.isfile():
+                    continue
+                entry = inventory.Entry(relPath, False, info.size, info.mtime)
+                yield entry, tar.extractfile(info)
+
+
+def _isLeading(relPath):
+    """Tells if an archive member belongs to the metadata written before the documents"""
+
+    return relPath is None or relPath.split('/')[0] == constants.BackupMetaDirname
+
+
+def readFile(path, relPath, leading=False):
+    """Returns the content of a file of a backup archive, or None if it is not found
+
+    If `leading` is True, the file is only looked for among the metadata
+    members at the start of the archive, so that compressed tar archives are
+    not read further.
+    """
+
+    if archiveFormat(path) == 'zip':
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                name = _relPath(info.filename)
+                if leading and not _isLeading(name):
+                    break
+                if not info.is_dir() and name == relPath:
+                    return zf.read(info)
+    else:
+        with tarfile.open(path, 'r|*') as tar:
+            for info in tar:
+                name = _relPath(info.name)
+                if leading and not _isLeading(name):
+                    break
+                if info.isfile() and name == relPath:
+                    return tar.extractfile(info).read()
+
+    return None
+
+
+def topLevelNames(path):
+    """Returns the names directly in the top-level folder of a backup archive
+
+    Raises ValueError if the members are not all inside a single top-level
+    folder.
+    """
+
+    if archiveFormat(path) == 'zip':
+        with zipfile.ZipFile(path) as zf:
+            names = zf.namelist()
+    else:
+        with tarfile.open(path) as tar:
+            names = tar.getnames()
+
+    topDirs = set()
+    children = set()
+    for name in names:
+        parts = [part for part in name.split('/') if part]
+        if not parts:
+            continue
+        topDirs.add(parts[0])
+        if len(parts) > 1:
+            children.add(parts[1])
+    if len(topDirs) > 1:
+        raise ValueError('Archive does not contain a single top-level folder.')
+
+    return sorted(children)
@@ -26,10 +26,19 @@
 
 
 import os
-import stat
+import re
+import shutil
+import shlex
+import tarfile
 import posixpath
 from datetime import datetime
 import socket
+import threading
+import contextlib
+import tempfile
+import io
+import time
+import hashlib
 import paramiko
 
 from PyQt5.QtCore import QObject
@@ -37,56 +46,528 @@ from PyQt5.QtCore import QObject
 # mature enough.
 from PyQt5.QtCore import pyqtSignal as Signal
 
+import rmexplorer.constants as constants
 import rmexplorer.tools as tools
+import rmexplorer.inventory as inventory
+import rmexplorer.archives as archives
+import rmexplorer.manifest as manifest
+import rmexplorer.selection as selection
 from rmexplorer.settings import Settings
+from rmexplorer.sftppool import SftpPool
 
 
 class BackupDocsWorker(QObject):
 
     notifyProgress = Signal(int)
     notifyNSteps = Signal(int)
+    notifyFileBytes = Signal(str, int, int)
+    notifyFileDone = Signal(str)
     warning = Signal(str)
     finished = Signal()
 
 
-    def __init__(self, destFolder, masterKey):
+    def __init__(self, destFolder, masterKey, collectionIds=None):
+        """If `collectionIds` is given, only these collections and their content are backed up"""
 
         super().__init__()
 
         self._settings = Settings(masterKey)
         self._destFolder = destFolder
+        self._collectionIds = collectionIds
+        self._count = 0
+        self._countLock = threading.Lock()
+        # Serializes the writes to an archive from the transfer threads
+        self._archiveLock = threading.Lock()
+        self._manifest = manifest.Manifest()
+        # Journal of a backup folder, None for archives which cannot be resumed
+        self._journal = None
+        self._complete = False
 
 
-    def _countRemoteElems(self, sftpClient, root, count=0):
-        """Counts the number of files and folders recursively in a path"""
+    def _step(self):
+        """Counts one more element as processed"""
 
-        for name in sftpClient.listdir(root):
-            count += 1
-            path = posixpath.join(root, name)
-            lstat = sftpClient.lstat(path)
-            if stat.S_ISDIR(lstat.st_mode):
-                count += self._countRemoteElems(sftpClient, path, count=0)
+        with self._countLock:
+            self._count += 1
+            self.notifyProgress.emit(self._count)
 
-        return count
 
+    def _snapshots(self, complete):
+        """Returns the names of the complete or of the interrupted backup folders
 
-    def _recursiveDownload(self, sftpClient, root, destRoot, count=0):
+        Names sort chronologically.
+        """
 
-        for name in sftpClient.listdir(root):
-            count += 1
-            self.notifyProgress.emit(count)
-            path = posixpath.join(root, name)
-            destPath = os.path.join(destRoot, name)
-            lstat = sftpClient.lstat(path)
-            if stat.S_ISDIR(lstat.st_mode):
-                os.mkdir(destPath)
-                count = self._recursiveDownload(sftpClient,
-                                                path, destPath,
-                                                count)
+        return sorted(name for name in os.listdir(self._destFolder)
+                      if re.match(constants.BackupDirRegexp, name)
+                      and os.path.isdir(os.path.join(self._destFolder, name))
+                      and manifest.isComplete(os.path.join(self._destFolder, name)) == complete)
+
+
+    def _previousSnapshot(self):
+        """Returns the path to the latest complete backup in the destination folder, or None"""
+
+        names = self._snapshots(True)
+        if not names:
+            return None
+
+        return os.path.join(self._destFolder, names[-1])
+
+
+    def _interruptedSnapshot(self):
+        """Returns the path to the latest interrupted backup in the destination folder, or None"""
+
+        names = self._snapshots(False)
+        if not names:
+            return None
+
+        return os.path.join(self._destFolder, names[-1])
+
+
+    def _selection(self):
+        """Returns what the backup contains according to its parameters and the settings"""
+
+        return {'collections': (None if self._collectionIds is None
+                                else sorted(self._collectionIds)),
+                'excludes': selection.parsePatterns(self._settings.value('BackupExcludePatterns', type=str)),
+                'skipTrash': self._settings.value('BackupSkipTrash', type=bool)}
+
+
+    def _resumableSnapshot(self, name):
+        """Returns the path to an interrupted backup to resume, or None
+
+        Only the latest interrupted backup is resumed, if it was started with
+        the same selection. It is renamed to `name` so that its name gives
+        the time of the backup that completes it.
+        """
+
+        folder = self._interruptedSnapshot()
+        if folder is None:
+            return None
+        journal = manifest.Journal(folder)
+        journal.close()
+        if journal.selection != self._selection():
+            return None
+        newFolder = os.path.join(self._destFolder, name)
+        try:
+            os.rename(folder, newFolder)
+        except OSError:
+            return folder
+
+        return newFolder
+
+
+    def _filterEntries(self, ssh, entries, root):
+        """Removes from the inventory of remote folder `root` what must not be backed up
+
+        The selection is recorded in the manifest so that a restore leaves
+        the other files of the tablet untouched.
+        """
+
+        backupSelection = self._selection()
+        excludes = backupSelection['excludes']
+        skipTrash = backupSelection['skipTrash']
+        self._manifest.excludes = excludes
+        self._manifest.skipTrash = skipTrash
+        entries = [entry for entry in entries
+                   if not selection.isExcluded(entry.path, excludes)]
+        if self._collectionIds is None and not skipTrash:
+            return entries
+
+        metadata = inventory.remoteMetadata(ssh, root)
+        if self._collectionIds is not None:
+            documents = selection.selectDocuments(metadata, self._collectionIds)
+            self._manifest.documents = documents
+            entries = [entry for entry in entries
+                       if selection.documentId(entry.path) in documents]
+        if skipTrash:
+            trashed = selection.trashedDocuments(metadata)
+            entries = [entry for entry in entries
+                       if selection.documentId(entry.path) not in trashed]
+
+        return entries
+
+
+    def _resumeOffset(self, entry, destPath):
+        """Returns the size of the part of a file saved by an interrupted backup
+
+        Returns 0 if the file must be downloaded from the start.
+        """
+
+        started = self._journal.started.get(entry.path)
+        if (started is None or started[0] != entry.size
+                or int(started[1]) != int(entry.mtime)
+                or not os.path.isfile(destPath)):
+            return 0
+        size = os.path.getsize(destPath)
+
+        return size if size < entry.size else 0
+
+
+    def _getFile(self, sftpClient, path, entry, destPath):
+        """Downloads a file, giving it the modification time of the remote file
+
+        A file partially downloaded by an interrupted backup is completed.
+        """
+
+        offset = self._resumeOffset(entry, destPath)
+        self._journal.start(entry.path, entry.size, entry.mtime)
+        if offset:
+            with open(destPath, 'r+b') as f:
+                hashingFile = manifest.HashingFile(f)
+                # The saved part is read again for the hash
+                while hashingFile.read(constants.SSHChunkSize):
+                    pass
+                with sftpClient.open(path, 'rb') as remoteFile:
+                    remoteFile.seek(offset)
+                    remoteFile.prefetch(entry.size)
+                    while True:
+                        chunk = remoteFile.read(constants.SSHChunkSize)
+                        if not chunk:
+                            break
+                        hashingFile.write(chunk)
+        else:
+            self._removeExisting(destPath)
+            with open(destPath, 'wb') as f:
+                hashingFile = manifest.HashingFile(f)
+                sftpClient.getfo(path, hashingFile)
+        self._manifest.add(entry.path, hashingFile.size, hashingFile.hexdigest())
+        # The remote mtime is what tells the next incremental backup whether
+        # this copy is still up to date.
+        os.utime(destPath, (entry.mtime, entry.mtime))
+        self._journal.finish(entry.path, hashingFile.size, entry.mtime,
+                             hashingFile.hexdigest())
+
+
+    def _getFileDelta(self, sftpClient, path, entry, destPath, prevPath, remoteBlocks):
+        """Downloads the blocks of a file that differ from its copy in the previous backup
+
+        `remoteBlocks` are the block hashes of the remote file, as returned by
+        `inventory.remoteBlockHashes`. The other blocks are copied from
+        `prevPath`.
+        """
+
+        self._journal.start(entry.path, entry.size, entry.mtime)
+        self._removeExisting(destPath)
+        with open(prevPath, 'rb') as prevFile, open(destPath, 'wb') as f, \
+                sftpClient.open(path, 'rb') as remoteFile:
+            hashingFile = manifest.HashingFile(f)
+            for i, remoteHash in enumerate(remoteBlocks):
+                block = prevFile.read(constants.DeltaBlockSize)
+                if hashlib.md5(block).hexdigest() != remoteHash:
+                    remoteFile.seek(i * constants.DeltaBlockSize)
+                    block = remoteFile.read(constants.DeltaBlockSize)
+                hashingFile.write(block)
+        self._manifest.add(entry.path, hashingFile.size, hashingFile.hexdigest())
+        os.utime(destPath, (entry.mtime, entry.mtime))
+        self._journal.finish(entry.path, hashingFile.size, entry.mtime,
+                             hashingFile.hexdigest())
+
+
+    @staticmethod
+    def _removeExisting(destPath):
+        """Removes a file left by an interrupted backup before it is written again
+
+        The file can be a hard link to a file of the previous backup, which
+        must not be modified.
+        """
+
+        if os.path.lexists(destPath):
+            os.remove(destPath)
+
+
+    @staticmethod
+    def _linkFile(srcPath, destPath):
+        """Hard-links a file of a previous backup, or copies it if links are not supported"""
+
+        if os.path.lexists(destPath):
+            os.remove(destPath)
+        try:
+            os.link(srcPath, destPath)
+        except OSError:
+            shutil.copy2(srcPath, destPath)
+
+
+    def _prepare(self, entries, dest, prevRoot=None):
+        """Recreates the remote folders in the backup and reuses unchanged files
+
+        `entries` is the inventory of the remote folder and `dest` is the
+        backup folder or an ArchiveWriter. If `prevRoot` is the path to a
+        previous backup folder, its files that have the same size and
+        modification time as the remote ones are linked instead of being
+        downloaded. Returns the entries of the files still to download.
+        """
+
+        if isinstance(dest, archives.ArchiveWriter):
+            # The index comes first so that restores need not read the whole
+            # archive to know its content.
+            index = manifest.Index(entries, self._manifest.documents,
+                                   self._manifest.excludes, self._manifest.skipTrash)
+            data = index.toBytes()
+            now = time.time()
+            dest.addDir(constants.BackupMetaDirname, now)
+            dest.addFile(manifest.IndexRelPath, io.BytesIO(data), len(data), now)
+            for entry in entries:
+                if entry.isDir:
+                    dest.addDir(entry.path, entry.mtime)
+                    self._step()
+            return [entry for entry in entries if not entry.isDir]
+
+        if self._journal.done or self._journal.started:
+            self._removeDeleted(entries, dest)
+
+        prevEntries = {}
+        prevManifest = None
+        if prevRoot is not None:
+            prevEntries = {entry.path: entry
+                           for entry in inventory.localInventory(prevRoot)}
+            prevManifest = manifest.Manifest.load(prevRoot)
+
+        toDownload = []
+        for entry in entries:
+            destPath = os.path.join(dest, *entry.path.split('/'))
+            if entry.isDir:
+                os.makedirs(destPath, exist_ok=True)
+                self._step()
+                continue
+            done = self._journal.done.get(entry.path)
+            if (done is not None and done[0] == entry.size
+                    and int(done[1]) == int(entry.mtime)
+                    and os.path.isfile(destPath)
+                    and os.path.getsize(destPath) == entry.size):
+                # Saved by the interrupted backup being resumed
+                self._manifest.add(entry.path, entry.size, done[2])
+                self._step()
+                continue
+            prevEntry = prevEntries.get(entry.path)
+            if (prevEntry is not None and not prevEntry.isDir
+                    and prevEntry.size == entry.size
+                    and int(prevEntry.mtime) == int(entry.mtime)):
+                self._linkFile(os.path.join(prevRoot, *entry.path.split('/')),
+                               destPath)
+                if (prevManifest is not None and entry.path in prevManifest.files
+                        and prevManifest.files[entry.path][0] == entry.size):
+                    self._manifest.add(entry.path, *prevManifest.files[entry.path])
+                else:
+                    with open(destPath, 'rb') as f:
+                        self._manifest.add(entry.path, entry.size, inventory.fileHash(f))
+                self._journal.finish(entry.path, entry.size, entry.mtime,
+                                     self._manifest.files[entry.path][1])
+                self._step()
             else:
-                sftpClient.get(path, destPath)
+                toDownload.append(entry)
+
+        return toDownload
+
+
+    @staticmethod
+    def _removeDeleted(entries, folder):
+        """Removes from an interrupted backup what is no longer on the tablet"""
+
+        remotePaths = {entry.path: entry.isDir for entry in entries}
+        for entry in reversed(inventory.localInventory(folder)):
+            if manifest.isMetadata(entry.path):
+                continue
+            isDir = remotePaths.get(entry.path)
+            if isDir is None or isDir != entry.isDir:
+                path = os.path.join(folder, *entry.path.split('/'))
+                if entry.isDir:
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+
+    def _saveFile(self, relPath, fileObj, size, mtime, dest):
+        """Saves a file read from `fileObj` in the backup
+
+        `dest` is the backup folder or an ArchiveWriter.
+        """
+
+        def progress(received):
+            self.notifyFileBytes.emit(relPath, received, size)
+
+        fileObj = manifest.HashingFile(fileObj)
+        if isinstance(dest, archives.ArchiveWriter):
+            dest.addFile(relPath, fileObj, size, mtime, progress)
+        else:
+            destPath = os.path.join(dest, *relPath.split('/'))
+            self._journal.start(relPath, size, mtime)
+            self._removeExisting(destPath)
+            received = 0
+            with open(destPath, 'wb') as f:
+                while True:
+                    chunk = fileObj.read(constants.SSHChunkSize)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+                    progress(received)
+            os.utime(destPath, (mtime, mtime))
+            self._journal.finish(relPath, fileObj.size, mtime, fileObj.hexdigest())
+        self._manifest.add(relPath, fileObj.size, fileObj.hexdigest())
+        self.notifyFileDone.emit(relPath)
+
+
+    def _getArchiveFile(self, sftpClient, path, entry, writer):
+        """Downloads a file and adds it to an archive
+
+        Large files are held in a temporary file rather than in memory until
+        the archive is free.
+        """
+
+        with tempfile.SpooledTemporaryFile(max_size=constants.SpoolMaxSize) as buf:
+            size = sftpClient.getfo(path, buf)
+            buf.seek(0)
+            with self._archiveLock:
+                self._saveFile(entry.path, buf, size, entry.mtime, writer)
+
+
+    def _deltaBlocks(self, ssh, files, root, prevRoot):
+        """Returns the block hashes of the remote files that can be transferred by blocks
+
+        These are the large files to download that have a copy in previous
+        backup folder `prevRoot`. The returned dictionary maps their paths to
+        their block hashes.
+        """
+
+        if prevRoot is None or not self._settings.value('DeltaTransfer', type=bool):
+            return {}
+        sizes = {entry.path: entry.size for entry in files
+                 if entry.size >= constants.DeltaMinFileSize
+                 and os.path.isfile(os.path.join(prevRoot, *entry.path.split('/')))}
+        blocks = inventory.remoteBlockHashes(ssh, root, sorted(sizes))
+
+        # Files whose hashes were not all received are downloaded in full
+        return {path: hashes for path, hashes in blocks.items()
+                if path in sizes
+                and len(hashes) == -(-sizes[path] // constants.DeltaBlockSize)}
+
 
-        return count
+    def _sftpDownload(self, ssh, files, root, dest, prevRoot=None):
+        """Downloads files over parallel SFTP channels
+
+        `files` are inventory entries of files in remote folder `root` and
+        `dest` is the backup folder or an ArchiveWriter. If `prevRoot` is the
+        path to a previous backup folder, large files are transferred by
+        blocks when the DeltaTransfer setting is set. Returns a list of
+        warnings.
+        """
+
+        deltaBlocks = {}
+        if not isinstance(dest, archives.ArchiveWriter):
+            deltaBlocks = self._deltaBlocks(ssh, files, root, prevRoot)
+        futures = {}
+        with SftpPool(ssh, self._settings.value('SFTPChannels', type=int)) as sftpPool:
+            for entry in files:
+                path = posixpath.join(root, entry.path)
+                if isinstance(dest, archives.ArchiveWriter):
+                    # Files are fetched in parallel but written one at a time
+                    future = sftpPool.submit(self._getArchiveFile, path, entry, dest)
+                elif entry.path in deltaBlocks:
+                    destPath = os.path.join(dest, *entry.path.split('/'))
+                    prevPath = os.path.join(prevRoot, *entry.path.split('/'))
+                    future = sftpPool.submit(self._getFileDelta, path, entry, destPath,
+                                             prevPath, deltaBlocks[entry.path])
+                else:
+                    destPath = os.path.join(dest, *entry.path.split('/'))
+                    future = sftpPool.submit(self._getFile, path, entry, destPath)
+                future.add_done_callback(lambda future: self._step())
+                futures[future] = path
+
+        return ['%s: %s' % (path, future.exception())
+                for future, path in futures.items()
+                if future.exception() is not None]
+
+
+    def _tarDownload(self, ssh, files, root, dest):
+        """Downloads files as a single tar stream produced on the tablet
+
+        `files` are inventory entries of files in remote folder `root` and
+        `dest` is the backup folder or an ArchiveWriter. Returns a list of
+        warnings.
+        """
+
+        if not files:
+            return []
+
+        compress = self._settings.value('TarCompression', type=bool)
+        command = 'tar c%sf - -C %s -T -' % ('z' if compress else '',
+                                              shlex.quote(root))
+        chanIn, chanOut, chanErr = ssh.exec_command(command,
+                                                    timeout=constants.SSHTimeout)
+
+        # tar starts sending files before it has read the whole list, so the
+        # list is written from another thread to avoid filling both ways of
+        # the channel.
+        def sendList():
+            try:
+                for entry in files:
+                    chanIn.write(entry.path.encode('utf-8', 'surrogateescape') + b'\n')
+            finally:
+                chanIn.channel.shutdown_write()
+        sender = threading.Thread(target=sendList, daemon=True)
+        sender.start()
+
+        # Only regular files that were asked for are extracted, so a member
+        # name cannot make the archive write outside of the backup folder.
+        pending = {entry.path for entry in files}
+        with tarfile.open(fileobj=chanOut, mode='r|gz' if compress else 'r|') as tar:
+            for member in tar:
+                relPath = posixpath.normpath(member.name)
+                if not member.isfile() or relPath not in pending:
+                    continue
+                pending.remove(relPath)
+                self._saveFile(relPath, tar.extractfile(member),
+                               member.size, member.mtime, dest)
+                self._step()
+        sender.join()
+
+        warnings = []
+        if chanOut.channel.recv_exit_status() != 0:
+            err = chanErr.read().decode('utf-8', 'replace').strip()
+            warnings.append('tar: %s' % err)
+        warnings += ['%s: not received' % posixpath.join(root, path)
+                     for path in sorted(pending)]
+
+        return warnings
+
+
+    def _saveManifest(self, dest):
+        """Writes the manifest of the files saved in the backup
+
+        `dest` is the backup folder or an ArchiveWriter.
+        """
+
+        if isinstance(dest, archives.ArchiveWriter):
+            data = self._manifest.toBytes()
+            now = time.time()
+            dest.addFile(manifest.ManifestRelPath, io.BytesIO(data), len(data), now)
+        else:
+            self._manifest.save(dest)
+
+
+    def _backup(self, ssh, entries, root, dest, prevRoot=None):
+        """Copies the content of remote folder `root` to the backup
+
+        `entries` is the inventory of `root` and `dest` is the backup folder
+        or an ArchiveWriter. A backup folder only gets its manifest once all
+        the files were saved, until then its journal allows resuming it.
+        Returns a list of warnings.
+        """
+
+        files = self._prepare(entries, dest, prevRoot)
+        if self._settings.value('BackupMethod', type=str) == 'tar':
+            warnings = self._tarDownload(ssh, files, root, dest)
+        else:
+            warnings = self._sftpDownload(ssh, files, root, dest, prevRoot)
+        if self._journal is None:
+            self._saveManifest(dest)
+        elif not warnings:
+            self._saveManifest(dest)
+            self._journal.remove()
+            self._complete = True
+
+        return warnings
 
 
     def start(self):
@@ -99,20 +580,43 @@ class BackupDocsWorker(QObject):
         warnings = []
 
         try:
-            with tools.openSftp(self._settings) as sftp:
-                destFolder = os.path.join(self._destFolder,
-                                          datetime.strftime(datetime.now(), 'remarkable_bak_%Y%m%d_%H%M%S'))
-                try:
-                    os.mkdir(destFolder)
-                except FileExistsError:
-                    warnings.append('Path "%s" already exists.' % destFolder)
+            with tools.openSsh(self._settings) as ssh, contextlib.closing(ssh.open_sftp()) as sftp:
+                root = self._settings.value('TabletDocumentsDir', type=str)
+                name = datetime.strftime(datetime.now(), constants.BackupDirFormat)
+                fmt = self._settings.value('BackupFormat', type=str)
+                if fmt in archives.Formats:
+                    destPath = os.path.join(self._destFolder,
+                                            name + archives.Formats[fmt][0])
+                    if os.path.exists(destPath):
+                        warnings.append('Path "%s" already exists.' % destPath)
+                    else:
+                        entries = self._filterEntries(ssh, inventory.remoteInventory(ssh, sftp, root),
+                                                      root)
+                        self.notifyNSteps.emit(len(entries))
+                        with archives.ArchiveWriter(destPath, fmt) as writer:
+                            warnings += self._backup(ssh, entries, root, writer)
                 else:
-                    nFiles = self._countRemoteElems(sftp,
-                                                    self._settings.value('TabletDocumentsDir', type=str))
-                    self.notifyNSteps.emit(nFiles)
-                    self._recursiveDownload(sftp,
-                                            self._settings.value('TabletDocumentsDir', type=str),
-                                            destFolder)
+                    prevFolder = None
+                    if self._settings.value('IncrementalBackups', type=bool):
+                        prevFolder = self._previousSnapshot()
+                    # An interrupted backup is resumed rather than started over
+                    destFolder = self._resumableSnapshot(name)
+                    if destFolder is None:
+                        destFolder = os.path.join(self._destFolder, name)
+                        try:
+                            os.mkdir(destFolder)
+                        except FileExistsError:
+                            warnings.append('Path "%s" already exists.' % destFolder)
+                            destFolder = None
+                    if destFolder is not None:
+                        self._journal = manifest.Journal(destFolder)
+                        if self._journal.selection is None:
+                            self._journal.setSelection(self._selection())
+                        entries = self._filterEntries(ssh, inventory.remoteInventory(ssh, sftp, root),
+                                                      root)
+                        self.notifyNSteps.emit(len(entries))
+                        warnings += self._backup(ssh, entries, root, destFolder,
+                                                 prevFolder)
         except socket.timeout:
             warnings.append('SSH timeout.')
         except socket.error:
@@ -122,6 +626,12 @@ class BackupDocsWorker(QObject):
         except Exception as e:
             warnings.append('Error: %s' % e)
 
+        if self._journal is not None:
+            self._journal.close()
+            if not self._complete:
+                warnings.append('The backup in "%s" is incomplete. Run the backup again to resume it.'
+                                % destFolder)
+
         if warnings:
             msg = '\n'.join(warnings)
             self.warning.emit(msg)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+"""Catalog of the documents contained in the backups of a folder"""
+
+
+import os
+import re
+import json
+import sqlite3
+import contextlib
+import collections
+
+from PyQt5.QtCore import QStandardPaths
+
+import rmexplorer.constants as constants
+import rmexplorer.archives as archives
+import rmexplorer.manifest as manifest
+
+
+# `snapshot` is the path to the backup folder or archive, `modified` is in
+# milliseconds since the epoch.
+Document = collections.namedtuple('Document', ['snapshot', 'uuid', 'name', 'type',
+                                               'version', 'modified'])
+
+
+def listSnapshots(folder):
+    """Returns the paths to the complete backup folders and archives in `folder`, oldest first"""
+
+    snapshots = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        # Snapshot names have no dots, archives are named after them
+        if not re.match(constants.BackupDirRegexp, name.split('.')[0]):
+            continue
+        if os.path.isdir(path):
+            if name == name.split('.')[0] and manifest.isComplete(path):
+                snapshots.append(path)
+        elif archives.archiveFormat(name) is not None:
+            snapshots.append(path)
+
+    return sorted(snapshots, key=lambda path: os.path.basename(path))
+
+
+def _stamp(path):
+    """Returns a string that changes when a backup folder or archive is rewritten"""
+
+    if os.path.isdir(path):
+        manifestPath = os.path.join(path, *manifest.ManifestRelPath.split('/'))
+        if os.path.isfile(manifestPath):
+            path = manifestPath
+    st = os.stat(path)
+
+    return '%d:%d' % (st.st_size, st.st_mtime_ns)
+
+
+def _parseMetadata(snapshot, filename, data):
+    """Returns the Document described by the content of a .metadata file, or None"""
+
+    try:
+        metadata = json.loads(data.decode('utf-8'))
+        return Document(snapshot, filename[:-len('.metadata')],
+                        str(metadata.get('visibleName', '')),
+                        str(metadata.get('type', '')),
+                        int(metadata.get('version', 0)),
+                        int(metadata.get('lastModified', 0)))
+    except (ValueError, AttributeError):
+        return None
+
+
+def readDocuments(snapshot):
+    """Returns the documents and collections of a backup folder or archive"""
+
+    documents = []
+    if os.path.isfile(snapshot):
+        # Archives are read in a single pass
+        for entry, fileObj in archives.iterFiles(snapshot):
+            if '/' not in entry.path and entry.path.endswith('.metadata'):
+                documents.append(_parseMetadata(snapshot, entry.path, fileObj.read()))
+    else:
+        for name in os.listdir(snapshot):
+            path = os.path.join(snapshot, name)
+            if name.endswith('.metadata') and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    documents.append(_parseMetadata(snapshot, name, f.read()))
+
+    return [document for document in documents if document is not None]
+
+
+class SnapshotCatalog():
+    """Stores in a SQLite database the documents contained in each backup
+
+    Backups are indexed from the .metadata files of the tablet, and indexed
+    again only when they change. A new connection is opened for each
+    operation, which makes instances usable from any thread.
+    """
+
+    def __init__(self, path=None):
+
+        if path is None:
+            folder = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, constants.CatalogFilename)
+        self._path = path
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                         'path TEXT NOT NULL PRIMARY KEY, '
+                         'folder TEXT NOT NULL, '
+                         'stamp TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS documents ('
+                         'snapshot TEXT NOT NULL, '
+                         'uuid TEXT NOT NULL, '
+                         'name TEXT NOT NULL, '
+                         'type TEXT NOT NULL, '
+                         'version INTEGER NOT NULL, '
+                         'modified INTEGER NOT NULL, '
+                         'PRIMARY KEY (snapshot, uuid))')
+            conn.execute('CREATE INDEX IF NOT EXISTS documents_uuid ON documents (uuid)')
+            conn.execute('CREATE INDEX IF NOT EXISTS documents_name '
+                         'ON documents (name COLLATE NOCASE)')
+
+
+    @contextlib.contextmanager
+    def _connect(self):
+
+        with contextlib.closing(sqlite3.connect(self._path,
+                                                timeout=constants.SQLiteTimeout)) as conn:
+            with conn:
+                yield conn
+
+
+    def outdated(self, folder):
+        """Returns the backups of `folder` that must be indexed
+
+        Backups that no longer exist are removed from the catalog. The
+        returned list contains pairs of a backup path and of the stamp to
+        pass to `index()`.
+        """
+
+        snapshots = {path: _stamp(path) for path in listSnapshots(folder)}
+        with self._connect() as conn:
+            known = dict(conn.execute('SELECT path, stamp FROM snapshots WHERE folder = ?',
+                                      (folder,)))
+            for path in set(known) - set(snapshots):
+                conn.execute('DELETE FROM documents WHERE snapshot = ?', (path,))
+                conn.execute('DELETE FROM snapshots WHERE path = ?', (path,))
+
+        return [(path, stamp) for path, stamp in sorted(snapshots.items())
+                if known.get(path) != stamp]
+
+
+    def index(self, snapshot, stamp):
+        """Stores the documents of a backup folder or archive"""
+
+        documents = readDocuments(snapshot)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM documents WHERE snapshot = ?', (snapshot,))
+            conn.executemany('INSERT INTO documents (snapshot, uuid, name, type, version, modified) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', documents)
+            conn.execute('INSERT OR REPLACE INTO snapshots (path, folder, stamp) VALUES (?, ?, ?)',
+                         (snapshot, os.path.dirname(snapshot), stamp))
+
+
+    def findDocuments(self, folder, text):
+        """Returns the versions of the documents whose name contains `text` or whose UUID is `text`
+
+        Only the backups of `folder` are searched. Documents are sorted by
+        name, and the versions of each document from the latest backup.
+        """
+
+        pattern = '%%%s%%' % re.sub(r'([\\%_])', r'\\\1', text)
+        with self._connect() as conn:
+            rows = conn.execute('SELECT d.snapshot, d.uuid, d.name, d.type, d.version, d.modified '
+                                'FROM documents d JOIN snapshots s ON d.snapshot = s.path '
+                                'WHERE s.folder = ? AND (d.uuid = ? OR d.name LIKE ? ESCAPE ?) '
+                                'ORDER BY d.name COLLATE NOCASE, d.uuid, d.snapshot DESC',
+                                (folder, text, pattern, '\\')).fetchall()
+
+        return [Document(*row) for row in rows]
+
+
+    def snapshotsOf(self, uuid):
+        """Returns the paths to the backups that contain the document with UUID `uuid`, latest first"""
+
+        with self._connect() as conn:
+            rows = conn.execute('SELECT snapshot FROM documents WHERE uuid = ?',
+                                (uuid,)).fetchall()
+
+        return sorted((row[0] for row in rows), key=os.path.basename, reverse=True)
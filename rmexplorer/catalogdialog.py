@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+"""Qt dialog to find a document in the backups and select a version to restore"""
+
+
+import os
+from datetime import datetime
+
+from PyQt5.QtWidgets import (QLabel, QLineEdit, QPushButton, QTableWidget,
+                             QTableWidgetItem, QAbstractItemView, QHeaderView,
+                             QHBoxLayout, QVBoxLayout, QMessageBox)
+
+import rmexplorer.constants as constants
+from rmexplorer.okcanceldialog import OKCancelDialog
+
+
+class CatalogDialog(OKCancelDialog):
+
+    def __init__(self, catalog, folder, parent=None):
+
+        super().__init__(parent=parent)
+
+        self._catalog = catalog
+        self._folder = folder
+        self._documents = []
+
+        self.searchLE = QLineEdit(self)
+        self.searchLE.setPlaceholderText('Document name or UUID')
+        self.searchLE.returnPressed.connect(self.search)
+        self.searchBtn = QPushButton('Search', self)
+        self.searchBtn.clicked.connect(self.search)
+        self.table = QTableWidget(0, 4, self)
+        self.table.setHorizontalHeaderLabels(['Name', 'Backup', 'Version', 'Last modified'])
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.verticalHeader().hide()
+        self.table.itemDoubleClicked.connect(self.ok)
+        self.okButton.setText('Restore')
+        # Return key starts a search rather than a restore
+        self.okButton.setAutoDefault(False)
+        self.searchBtn.setAutoDefault(False)
+
+        searchLayout = QHBoxLayout()
+        searchLayout.addWidget(self.searchLE)
+        searchLayout.addWidget(self.searchBtn)
+        mainLayout = QVBoxLayout()
+        mainLayout.addWidget(QLabel('Backups in %s' % folder))
+        mainLayout.addLayout(searchLayout)
+        mainLayout.addWidget(self.table)
+        self.setLayout(mainLayout)
+
+        self.searchLE.setFocus()
+        self.resize(700, 400)
+
+        self.setWindowTitle('Find in backups')
+
+
+    def search(self):
+
+        self._documents = self._catalog.findDocuments(self._folder,
+                                                      self.searchLE.text().strip())
+        self.table.setRowCount(len(self._documents))
+        for row, document in enumerate(self._documents):
+            modified = ''
+            if document.modified:
+                modified = datetime.fromtimestamp(document.modified / 1000).strftime('%Y-%m-%d %H:%M')
+            values = [document.name, os.path.basename(document.snapshot),
+                      str(document.version), modified]
+            for col, value in enumerate(values):
+                self.table.setItem(row, col, QTableWidgetItem(value))
+
+
+    def selectedDocument(self):
+        """Returns the selected version of a document, or None"""
+
+        rows = self.table.selectionModel().selectedRows()
+        if not rows:
+            return None
+
+        return self._documents[rows[0].row()]
+
+
+    def ok(self):
+
+        if self.selectedDocument() is None:
+            QMessageBox.warning(self, constants.AppName,
+                                'Select the version of the document to restore.')
+            return
+
+        self.accept()
@@ -33,10 +33,56 @@ HttpShortTimeoutMin = 0
 HttpShortTimeoutMax = 60
 HttpShortTimeoutMaxDecimals = 3
 HttpJsonEncoding = 'utf-8'
+HttpChunkSize = 64 * 1024
 PngExportDpiMin = 30
 PngExportDpiMax = 10000
+DownloadConcurrencyMin = 1
+DownloadConcurrencyMax = 16
 PassphraseMinStrength = 0.7
 PassphraseMaxLen = 1024
 TestString = 'Can you read me?'
 SSHTimeout = 10.0
+SSHChunkSize = 64 * 1024
+# Files transiting between an archive and SFTP are kept in memory up to this
+# size, and written to a temporary file above
+SpoolMaxSize = 1024**2
+SSHKeepaliveInterval = 30
+SSHIdleTimeout = 300
+SSHPort = 22
+RouteProbeTimeout = 1.0
+RouteCacheMaxAge = 600
 StatusBarMsgDisplayDuration = 5000
+MirrorStateFilename = '.rmexplorer_mirror.json'
+TreeCacheFilename = 'treecache.sqlite'
+TreeCacheMaxAgeMin = 0
+TreeCacheMaxAgeMax = 604800
+SQLiteTimeout = 10.0
+ListingConcurrencyMin = 1
+ListingConcurrencyMax = 16
+PrefetchMaxCollections = 32
+DownloadQueueSize = 64
+RenderProcessesMin = 0
+RenderProcessesMax = 64
+ExportCacheDirname = 'exports'
+ExportCacheIndexFilename = 'index.sqlite'
+ExportCacheMaxMBMin = 0
+ExportCacheMaxMBMax = 1000000
+SFTPChannelsMin = 1
+SFTPChannelsMax = 16
+BackupDirFormat = 'remarkable_bak_%Y%m%d_%H%M%S'
+BackupDirRegexp = r'^remarkable_bak_\d{8}_\d{6}$'
+BackupMetaDirname = '.rmexplorer'
+ManifestFilename = 'manifest.json'
+IndexFilename = 'index.json'
+JournalFilename = 'journal'
+CatalogFilename = 'catalog.sqlite'
+VerifyConcurrency = 4
+VerifyMaxReportedFiles = 20
+# 1980-01-02, safely after the earliest date zip files can store
+ZipMinTimestamp = 315619200
+# Suffixes of the folders next to the tablet's documents folder used by staged restores
+RestoreStagingSuffix = '.rmexplorer-staging'
+RestoreOldSuffix = '.rmexplorer-old'
+# Files of at least DeltaMinFileSize bytes are transferred by blocks
+DeltaBlockSize = 256 * 1024
+DeltaMinFileSize = 4 * 1024 * 1024
@@ -26,31 +26,281 @@
 
 
 import os
+import queue
+import sqlite3
+import shutil
+import socket
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+import urllib.error
+import concurrent.futures
 
 from PyQt5.QtCore import QObject
 # Renaming below is to prepare for switch from PyQt5 to PySide2 when it will be
 # mature enough.
 from PyQt5.QtCore import pyqtSignal as Signal
 
-from rmexplorer.settings import Settings
+import rmexplorer.constants as constants
+from rmexplorer.settings import Settings, ThreadLocalSettings
+from rmexplorer.mirror import MirrorState
+from rmexplorer.treecache import TreeCache
+from rmexplorer.exportcache import ExportCache
+import rmexplorer.renderers as renderers
 import rmexplorer.tools as tools
 
 
 class DownloadFilesWorker(QObject):
 
     notifyProgress = Signal(int)
+    notifyNSteps = Signal(int)
+    notifyFileBytes = Signal(str, int, int)
+    notifyFileDone = Signal(str)
     warning = Signal(str)
     finished = Signal()
 
 
-    def __init__(self, folder, dlList, mode):
+    def __init__(self, folder, dlList, mode, mirror=False, dirs=()):
+        """Initializes the worker
+
+        `dlList` contains (fid, destRelPath, stamp) tuples where `stamp` is the
+        revision of the document given by tools.docStamp(), or None if
+        unknown.  The documents of the collections in `dirs`, a list of
+        (dirId, dirName) tuples, are added to the list while they are found
+        by a parallel crawl of the collections.  In `mirror` mode, documents
+        whose revision was already exported to the same path are skipped.
+        """
 
         super().__init__()
 
         self._settings = Settings()
+        self._threadSettings = ThreadLocalSettings()
+        self._treeCache = TreeCache()
         self._folder = folder
         self._dlList = dlList
+        self._dirs = dirs
         self._mode = mode
+        self._mirror = mirror
+        self._mirrorState = None
+        self._renderPool = None
+        self._renderSlots = None
+        # Opened by start(), in the worker's thread
+        self._exportCache = None
+
+
+    def _openExportCache(self, warnings):
+        """Opens the export cache if enabled, or adds a warning if it cannot be used"""
+
+        maxMB = self._settings.value('ExportCacheMaxMB', type=int)
+        if maxMB <= 0:
+            return
+        try:
+            self._exportCache = ExportCache(maxMB * 1024**2)
+        except (OSError, sqlite3.Error) as e:
+            warnings.append('Export cache disabled: %s' % e)
+
+
+    def _lookupInCache(self, key):
+
+        # An unusable cache only means that the document is downloaded.
+        try:
+            return self._exportCache.lookup(key)
+        except (OSError, sqlite3.Error):
+            return None
+
+
+    def _storeInCache(self, key, paths):
+
+        # The export itself succeeded: failing to cache it is not an error.
+        with contextlib.suppress(OSError, sqlite3.Error):
+            self._exportCache.store(key, paths)
+
+
+    def _download(self, elem):
+        """Downloads one element of the list as a PDF, from one of the pool threads"""
+
+        fid, destRelPath, stamp = elem
+        destPath = tools.exportPath(self._folder, destRelPath, 'pdf')
+        os.makedirs(os.path.split(destPath)[0], exist_ok=True)
+
+        key = None
+        if self._exportCache is not None and stamp is not None:
+            key = ExportCache.key(fid, stamp, 'pdf')
+            paths = self._lookupInCache(key)
+            if paths is not None:
+                tools.copyFile(paths[0], destPath)
+                return
+
+        def progress(received, total):
+            self.notifyFileBytes.emit(destRelPath, received, total)
+
+        tools.fetchPdf(fid, destPath, self._threadSettings.get(), progress)
+        if key is not None:
+            self._storeInCache(key, [destPath])
+
+
+    def _downloadForRender(self, elem, results):
+        """Downloads the PDF of an element and hands it over to the render pool
+
+        The result is reported to `results` once the PNG files are written,
+        while the calling thread can already start another download.  Pages
+        and PDF files found in the export cache are not downloaded again.
+        """
+
+        fid, destRelPath, stamp = elem
+        settings = self._threadSettings.get()
+        resolution = settings.value('PNGResolution', type=int)
+        # Backends give different images: 'auto' is resolved for the cache key
+        rendererName = renderers.getRenderer(settings.value('PNGRenderer', type=str)).name
+        destPath = tools.exportPath(self._folder, destRelPath, 'png')
+        os.makedirs(os.path.split(destPath)[0], exist_ok=True)
+
+        pngKey = None
+        pdfKey = None
+        if self._exportCache is not None and stamp is not None:
+            pngKey = ExportCache.key(fid, stamp, 'png', resolution, rendererName)
+            paths = self._lookupInCache(pngKey)
+            if paths is not None:
+                for src, dest in zip(paths, renderers.pngPagePaths(destPath, len(paths))):
+                    tools.copyFile(src, dest)
+                results.put(('downloaded', elem, None, len(paths)))
+                return
+            pdfKey = ExportCache.key(fid, stamp, 'pdf')
+
+        def progress(received, total):
+            self.notifyFileBytes.emit(destRelPath, received, total)
+
+        fd, pdfPath = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            paths = None if pdfKey is None else self._lookupInCache(pdfKey)
+            if paths is not None:
+                shutil.copyfile(paths[0], pdfPath)
+            else:
+                tools.fetchPdf(fid, pdfPath, settings, progress)
+                if pdfKey is not None:
+                    self._storeInCache(pdfKey, [pdfPath])
+            # Waits if the render pool is already busy enough.
+            self._renderSlots.acquire()
+            try:
+                future = self._renderPool.submit(renderers.renderPng, pdfPath, destPath,
+                                                 resolution, rendererName)
+            except BaseException:
+                self._renderSlots.release()
+                raise
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(pdfPath)
+            raise
+
+        def done(future):
+            # Exceptions raised here would be swallowed by the executor: the
+            # result is reported in any case, or the main loop would wait
+            # for it forever.
+            result = ('downloaded', elem, future.exception(), 0)
+            try:
+                self._renderSlots.release()
+                with contextlib.suppress(OSError):
+                    os.remove(pdfPath)
+                if result[2] is None:
+                    result = ('downloaded', elem, None, len(future.result()))
+                    if pngKey is not None:
+                        self._storeInCache(pngKey, future.result())
+            finally:
+                results.put(result)
+
+        future.add_done_callback(done)
+
+
+    def _downloadLoop(self, jobs, results):
+        """Downloads the elements put in `jobs` until a None is received"""
+
+        while True:
+            elem = jobs.get()
+            if elem is None:
+                return
+            try:
+                if self._renderPool is not None:
+                    self._downloadForRender(elem, results)
+                    continue
+                self._download(elem)
+            except Exception as e:
+                results.put(('downloaded', elem, e, 0))
+            else:
+                results.put(('downloaded', elem, None, 1))
+
+
+    def _listDir(self, dirId):
+        """Lists a collection, from one of the crawl threads"""
+
+        settings = self._threadSettings.get()
+        return self._treeCache.listDir(dirId, settings,
+                                       settings.value('TreeCacheMaxAge', type=int))
+
+
+    def _enqueue(self, elem, jobs, results):
+        """Passes a document found by the producer to the downloaders"""
+
+        fid, destRelPath, stamp = elem
+        results.put(('found',))
+        if (self._mirrorState is not None
+                and self._mirrorState.isUpToDate(fid, stamp, destRelPath)):
+            results.put(('skipped', elem))
+        else:
+            # Blocks when the downloaders are behind, which also pauses the
+            # crawl.
+            jobs.put(elem)
+
+
+    def _crawl(self, jobs, results):
+        """Lists the collections of `dirs` recursively, feeding `jobs` with their documents"""
+
+        nThreads = self._settings.value('ListingConcurrency', type=int)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as executor:
+            pending = {executor.submit(self._listDir, dirId): dirName
+                       for dirId, dirName in self._dirs}
+            while pending:
+                done, _ = concurrent.futures.wait(pending,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dirPath = pending.pop(future)
+                    try:
+                        data = future.result()
+                    except (urllib.error.URLError, socket.timeout) as e:
+                        msg = getattr(e, 'reason', 'timeout')
+                        results.put(('warning', '%s: URL error: %s' % (dirPath or '/', msg)))
+                        continue
+                    except (ValueError, OSError) as e:
+                        # Such as a reset connection: the other collections
+                        # are still crawled.
+                        results.put(('warning', '%s: %s' % (dirPath or '/', e)))
+                        continue
+                    for elem in data:
+                        path = os.path.join(dirPath, elem['VissibleName']) # yes, "Vissible"
+                        if elem['Type'] == 'DocumentType':
+                            self._enqueue((elem['ID'],
+                                           '%s.%s' % (path, self._mode),
+                                           tools.docStamp(elem)),
+                                          jobs, results)
+                        elif elem['Type'] == 'CollectionType':
+                            pending[executor.submit(self._listDir, elem['ID'])] = path
+
+
+    def _produce(self, jobs, results, nDownloaders):
+        """Feeds the downloaders, then tells them and the main loop to stop"""
+
+        try:
+            for elem in self._dlList:
+                self._enqueue(elem, jobs, results)
+            if self._dirs:
+                self._crawl(jobs, results)
+        except Exception as e:
+            results.put(('warning', 'Error: %s' % e))
+        finally:
+            for _ in range(nDownloaders):
+                jobs.put(None)
+            results.put(('produced',))
 
 
     def start(self):
@@ -61,14 +311,62 @@ class DownloadFilesWorker(QObject):
             return
 
         warnings = []
-        for i, elem in enumerate(self._dlList):
-            self.notifyProgress.emit(i)
-            fid, destRelPath = elem
-            try:
-                tools.downloadFile(fid, self._folder, destRelPath, self._mode,
-                                   self._settings)
-            except Exception as e:
-                warnings.append('%s: %s' % (destRelPath, str(e)))
+        if self._mirror:
+            self._mirrorState = MirrorState(self._folder, self._mode)
+        self._openExportCache(warnings)
+
+        nDownloaders = self._settings.value('DownloadConcurrency', type=int)
+        jobs = queue.Queue(maxsize=constants.DownloadQueueSize)
+        results = queue.Queue()
+        producer = threading.Thread(target=self._produce,
+                                    args=(jobs, results, nDownloaders))
+        if self._mode == 'png':
+            # Rendering is CPU-bound and runs in separate processes.  "spawn"
+            # avoids forking a process that runs Qt threads.
+            nRenderers = (self._settings.value('RenderProcesses', type=int)
+                          or os.cpu_count() or 1)
+            self._renderPool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=nRenderers,
+                mp_context=multiprocessing.get_context('spawn'))
+            self._renderSlots = threading.BoundedSemaphore(2 * nRenderers)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nDownloaders) as executor:
+                for _ in range(nDownloaders):
+                    executor.submit(self._downloadLoop, jobs, results)
+                producer.start()
+
+                produced = False
+                nFound = 0
+                count = 0
+                while not produced or count < nFound:
+                    msg = results.get()
+                    if msg[0] == 'found':
+                        nFound += 1
+                        self.notifyNSteps.emit(nFound)
+                    elif msg[0] == 'produced':
+                        produced = True
+                    elif msg[0] == 'warning':
+                        warnings.append(msg[1])
+                    else:
+                        fid, destRelPath, stamp = msg[1]
+                        if msg[0] == 'skipped':
+                            pass
+                        elif msg[2] is not None:
+                            warnings.append('%s: %s' % (destRelPath, str(msg[2])))
+                        elif self._mirrorState is not None:
+                            self._mirrorState.record(fid, stamp, destRelPath, msg[3])
+                        count += 1
+                        self.notifyFileDone.emit(destRelPath)
+                        self.notifyProgress.emit(count)
+                producer.join()
+        finally:
+            if self._renderPool is not None:
+                self._renderPool.shutdown()
+            if self._mirrorState is not None:
+                try:
+                    self._mirrorState.save()
+                except OSError as e:
+                    warnings.append('Could not save mirror state: %s' % e)
 
         if warnings:
             msg = 'Some errors were encountered:\n%s' % '\n'.join(warnings)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Local cache of exported documents"""
+
+
+import os
+import time
+import json
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+from PyQt5.QtCore import QStandardPaths
+
+import rmexplorer.constants as constants
+
+
+class ExportCache():
+    """Content-addressed cache of exported PDF files and rendered PNG pages
+
+    Each entry holds the files of one export, identified by a key computed
+    from the document ID, its revision stamp, the export format, and the PNG
+    resolution and renderer.  Entries are stored in folders named after their key, and an
+    SQLite index keeps their size and last use so that the least recently
+    used ones are evicted when the cache grows over `maxBytes`.  Instances
+    can be used from several threads.
+    """
+
+    def __init__(self, maxBytes, root=None):
+
+        if root is None:
+            root = os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation),
+                                constants.ExportCacheDirname)
+        os.makedirs(root, exist_ok=True)
+        self._root = root
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, '
+                         'files TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'lastUsed REAL NOT NULL)')
+
+
+    @contextlib.contextmanager
+    def _connect(self):
+
+        path = os.path.join(self._root, constants.ExportCacheIndexFilename)
+        with contextlib.closing(sqlite3.connect(path,
+                                                timeout=constants.SQLiteTimeout)) as conn:
+            with conn:
+                yield conn
+
+
+    @staticmethod
+    def key(fid, stamp, fmt, resolution=None, renderer=None):
+        """`renderer` is the name of the PNG backend, not 'auto'"""
+
+        if fmt == 'png':
+            desc = '%s\n%s\n%s\n%s\n%s' % (fid, stamp, fmt, resolution, renderer)
+        else:
+            desc = '%s\n%s\n%s\n' % (fid, stamp, fmt)
+        return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+
+    def _entryDir(self, key):
+
+        return os.path.join(self._root, key[:2], key)
+
+
+    def _remove(self, conn, key):
+
+        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        shutil.rmtree(self._entryDir(key), ignore_errors=True)
+
+
+    def lookup(self, key):
+        """Returns the list of files of an entry, or None if not cached"""
+
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT files FROM entries WHERE key = ?',
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            paths = [os.path.join(self._entryDir(key), name)
+                     for name in json.loads(row[0])]
+            if not all(os.path.isfile(path) for path in paths):
+                # Files were removed behind our back
+                self._remove(conn, key)
+                return None
+            conn.execute('UPDATE entries SET lastUsed = ? WHERE key = ?',
+                         (time.time(), key))
+        return paths
+
+
+    def store(self, key, paths):
+        """Copies the files of an export into the cache"""
+
+        if self._maxBytes <= 0:
+            return
+        names = ['%d%s' % (i, os.path.splitext(path)[1]) for i, path in enumerate(paths)]
+        size = sum(os.path.getsize(path) for path in paths)
+        if size > self._maxBytes:
+            return
+        # Files are copied to a temporary folder which is then renamed, so that
+        # an entry is never seen half-written.
+        tmpDir = tempfile.mkdtemp(dir=self._root, prefix='.tmp')
+        try:
+            for name, path in zip(names, paths):
+                shutil.copyfile(path, os.path.join(tmpDir, name))
+            entryDir = self._entryDir(key)
+            os.makedirs(os.path.dirname(entryDir), exist_ok=True)
+            with self._lock, self._connect() as conn:
+                self._remove(conn, key)
+                os.rename(tmpDir, entryDir)
+                conn.execute('INSERT INTO entries (key, files, size, lastUsed) VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(names), size, time.time()))
+                self._evict(conn)
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+    def _evict(self, conn):
+        """Removes the least recently used entries until the cache fits in its budget"""
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self._maxBytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY lastUsed').fetchall():
+            self._remove(conn, key)
+            total -= size
+            if total <= self._maxBytes:
+                break
+
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+"""Qt worker that adds the backups of a folder to the snapshot catalog"""
+
+
+from PyQt5.QtCore import QObject
+# Renaming below is to prepare for switch from PyQt5 to PySide2 when it will be
+# mature enough.
+from PyQt5.QtCore import pyqtSignal as Signal
+
+
+class IndexBackupsWorker(QObject):
+
+    notifyProgress = Signal(int)
+    notifyNSteps = Signal(int)
+    warning = Signal(str)
+    finished = Signal()
+
+
+    def __init__(self, catalog, folder):
+
+        super().__init__()
+
+        self._catalog = catalog
+        self._folder = folder
+
+
+    def start(self):
+
+        warnings = []
+        try:
+            snapshots = self._catalog.outdated(self._folder)
+            self.notifyNSteps.emit(len(snapshots))
+            for i, (path, stamp) in enumerate(snapshots):
+                try:
+                    self._catalog.index(path, stamp)
+                except Exception as e:
+                    # A damaged backup does not prevent searching the others
+                    warnings.append('%s: %s' % (path, e))
+                self.notifyProgress.emit(i + 1)
+        except Exception as e:
+            warnings.append('Error: %s' % e)
+
+        if warnings:
+            self.warning.emit('\n'.join(warnings))
+        self.finished.emit()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Listings of all the files and folders of a tree, with their attributes"""
+
+
+import os
+import stat
+import json
+import hashlib
+import shlex
+import posixpath
+import collections
+
+import rmexplorer.constants as constants
+import rmexplorer.tools as tools
+
+
+# `path` is relative to the root of the tree, with "/" separators. `mtime` is
+# in seconds since the epoch.
+Entry = collections.namedtuple('Entry', ['path', 'isDir', 'size', 'mtime'])
+
+
+def _findInventory(ssh, root):
+    """Lists a remote tree with a single `find` command
+
+    Returns None if the remote `find` does not support `-printf`.
+    """
+
+    # Records are NUL-terminated so that any file name can be parsed back.
+    command = 'find %s -mindepth 1 -printf "%%y %%s %%T@ %%P\\0"' % shlex.quote(root)
+    status, out, _ = tools.runCommand(ssh, command)
+    if status != 0:
+        return None
+
+    entries = []
+    for record in out.split(b'\0')[:-1]:
+        type_, size, mtime, path = record.decode('utf-8', 'surrogateescape').split(' ', 3)
+        entries.append(Entry(path, type_ == 'd', int(size), float(mtime)))
+
+    return entries
+
+
+def _sftpInventory(sftpClient, root):
+    """Lists a remote tree with one `listdir_attr` request per folder"""
+
+    entries = []
+    dirs = ['']
+    while dirs:
+        relDir = dirs.pop(0)
+        for attr in sftpClient.listdir_attr(posixpath.join(root, relDir)):
+            path = posixpath.join(relDir, attr.filename)
+            isDir = stat.S_ISDIR(attr.st_mode)
+            entries.append(Entry(path, isDir, attr.st_size, attr.st_mtime))
+            if isDir:
+                dirs.append(path)
+
+    return entries
+
+
+def remoteInventory(ssh, sftpClient, root):
+    """Lists all the files and folders below remote path `root`
+
+    Folders are always listed before their content. A single `find` command
+    is used when the tablet supports it, otherwise each folder is listed
+    through SFTP.
+    """
+
+    entries = _findInventory(ssh, root)
+    if entries is None:
+        entries = _sftpInventory(sftpClient, root)
+
+    return entries
+
+
+def localInventory(root):
+    """Lists all the files and folders below local path `root`
+
+    Folders are always listed before their content.
+    """
+
+    entries = []
+    dirs = ['']
+    while dirs:
+        relDir = dirs.pop(0)
+        with os.scandir(os.path.join(root, relDir)) as it:
+            for dirEntry in it:
+                path = posixpath.join(relDir, dirEntry.name)
+                isDir = dirEntry.is_dir(follow_symlinks=False)
+                st = dirEntry.stat(follow_symlinks=False)
+                entries.append(Entry(path, isDir, st.st_size, st.st_mtime))
+                if isDir:
+                    dirs.append(path)
+
+    return entries
+
+
+def fileHash(fileObj):
+    """Returns the SHA-256 hex digest of the content of a file object"""
+
+    h = hashlib.sha256()
+    while True:
+        chunk = fileObj.read(constants.SSHChunkSize)
+        if not chunk:
+            break
+        h.update(chunk)
+
+    return h.hexdigest()
+
+
+def remoteHashes(ssh, root, paths):
+    """Returns the SHA-256 hex digests of remote files with a single command
+
+    `paths` are relative to remote folder `root`. The returned dictionary
+    maps each path to its digest; files that could not be read are missing.
+    """
+
+    if not paths:
+        return {}
+
+    command = 'cd %s && xargs -0 sha256sum --' % shlex.quote(root)
+    stdin = b''.join(path.encode('utf-8', 'surrogateescape') + b'\0'
+                     for path in paths)
+    _, out, _ = tools.runCommand(ssh, command, stdin)
+
+    hashes = {}
+    for line in out.decode('utf-8', 'surrogateescape').splitlines():
+        digest, _, path = line.partition('  ')
+        hashes[path] = digest
+
+    return hashes
+
+
+def blockHashes(fileObj):
+    """Returns the MD5 hex digests of the successive blocks of a file object
+
+    Blocks are `constants.DeltaBlockSize` bytes long, except for the last one.
+    """
+
+    hashes = []
+    while True:
+        block = fileObj.read(constants.DeltaBlockSize)
+        if not block:
+            break
+        hashes.append(hashlib.md5(block).hexdigest())
+
+    return hashes
+
+
+def remoteBlockHashes(ssh, root, paths):
+    """Returns the block hashes of remote files with a single command
+
+    `paths` are relative to remote folder `root`. The returned dictionary
+    maps each path to a list as returned by `blockHashes`; files that could
+    not be read are missing.
+    """
+
+    if not paths:
+        return {}
+
+    # Each file is followed by the MD5 sums of its blocks, read with dd.
+    script = ('n=$(( ($(wc -c < "$1") + {size} - 1) / {size} )); '
+              'printf "%s\\0" "$1"; i=0; '
+              'while [ $i -lt $n ]; do '
+              'dd if="$1" bs={size} skip=$i count=1 2>/dev/null | md5sum; '
+              'i=$((i + 1)); done; '
+              'printf "\\0"').format(size=constants.DeltaBlockSize)
+    command = 'cd %s && xargs -0 -n 1 sh -c %s _' % (shlex.quote(root),
+                                                     shlex.quote(script))
+    stdin = b''.join(path.encode('utf-8', 'surrogateescape') + b'\0'
+                     for path in paths)
+    _, out, _ = tools.runCommand(ssh, command, stdin)
+
+    hashes = {}
+    records = out.split(b'\0')
+    for path, sums in zip(records[0::2], records[1::2]):
+        hashes[path.decode('utf-8', 'surrogateescape')] = [
+            line.split()[0].decode('ascii') for line in sums.splitlines() if line.strip()]
+
+    return hashes
+
+
+def remoteMetadata(ssh, root):
+    """Returns the content of the .metadata files of remote folder `root` with a single command
+
+    The returned dictionary maps UUIDs to parsed metadata. Files that cannot
+    be parsed are skipped.
+    """
+
+    # Each file name is followed by the file content, both NUL-terminated
+    command = ('cd %s && for f in *.metadata; do if [ -f "$f" ]; then '
+               'printf "%%s\\0" "$f"; cat -- "$f"; printf "\\0"; fi; done'
+               % shlex.quote(root))
+    _, out, _ = tools.runCommand(ssh, command)
+
+    metadata = {}
+    records = out.split(b'\0')
+    for name, data in zip(records[0::2], records[1::2]):
+        try:
+            content = json.loads(data.decode('utf-8'))
+        except ValueError:
+            continue
+        if isinstance(content, dict):
+            metadata[name.decode('utf-8', 'surrogateescape')[:-len('.metadata')]] = content
+
+    return metadata
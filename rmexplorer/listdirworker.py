@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Qt worker that lists collections in the background"""
+
+
+import socket
+import threading
+import urllib.error
+import concurrent.futures
+
+from PyQt5.QtCore import QObject
+# Renaming below is to prepare for switch from PyQt5 to PySide2 when it will be
+# mature enough.
+from PyQt5.QtCore import pyqtSignal as Signal
+
+from rmexplorer.settings import Settings, ThreadLocalSettings
+
+
+class ListDirWorker(QObject):
+    """Long-lived worker answering listing requests of the main window
+
+    Unlike the other workers, this one is not started once but lives in its
+    own thread for the whole session: listDir() and prefetch() are slots
+    connected to signals of the window.
+    """
+
+    listed = Signal(str, object, bool)
+    failed = Signal(str, str)
+
+
+    def __init__(self, treeCache):
+
+        super().__init__()
+
+        self._settings = Settings()
+        self._threadSettings = ThreadLocalSettings()
+        self._treeCache = treeCache
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._settings.value('ListingConcurrency', type=int))
+        # Prefetches not finished yet, cancelled by stop()
+        self._futures = set()
+        self._futuresLock = threading.Lock()
+
+
+    def listDir(self, dirId, maxAge):
+        """Lists a collection and emits `listed` or `failed`
+
+        See TreeCache.get() for the meaning of `maxAge`.
+        """
+
+        try:
+            data = self._treeCache.listDir(dirId, self._settings, maxAge)
+        except (urllib.error.URLError, socket.timeout) as e:
+            self.failed.emit(dirId, str(getattr(e, 'reason', 'timeout')))
+        except ValueError as e:
+            self.failed.emit(dirId, 'Invalid response: %s' % e)
+        else:
+            self.listed.emit(dirId, data, False)
+
+
+    def _prefetchOne(self, dirId):
+
+        settings = self._threadSettings.get()
+        try:
+            data = self._treeCache.listDir(dirId, settings,
+                                           settings.value('TreeCacheMaxAge', type=int))
+        except (urllib.error.URLError, socket.timeout, ValueError):
+            # Speculative request: the collection will be listed again if the
+            # user opens it.
+            return
+        self.listed.emit(dirId, data, True)
+
+
+    def prefetch(self, dirIds):
+        """Lists collections in parallel, emitting `listed` with the prefetched flag"""
+
+        for dirId in dirIds:
+            future = self._executor.submit(self._prefetchOne, dirId)
+            with self._futuresLock:
+                self._futures.add(future)
+            future.add_done_callback(self._discardFuture)
+
+
+    def _discardFuture(self, future):
+
+        with self._futuresLock:
+            self._futures.discard(future)
+
+
+    def stop(self):
+
+        # Executor.shutdown() only cancels pending calls from Python 3.9
+        with self._futuresLock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Manifests listing the size and SHA-256 hash of the files of a backup
+
+Backups keep their own files in a metadata folder at their root, which is not
+part of the tablet's documents.
+"""
+
+
+import os
+import json
+import hashlib
+import threading
+import posixpath
+
+import rmexplorer.constants as constants
+import rmexplorer.archives as archives
+import rmexplorer.inventory as inventory
+
+
+ManifestRelPath = posixpath.join(constants.BackupMetaDirname,
+                                 constants.ManifestFilename)
+IndexRelPath = posixpath.join(constants.BackupMetaDirname,
+                              constants.IndexFilename)
+JournalRelPath = posixpath.join(constants.BackupMetaDirname,
+                                constants.JournalFilename)
+
+
+def isMetadata(relPath):
+    """Tells if a path relative to the root of a backup is in the metadata folder"""
+
+    return relPath.split('/')[0] == constants.BackupMetaDirname
+
+
+def isComplete(folder):
+    """Tells if a backup folder was completely written
+
+    Backups that were interrupted have a journal and no manifest. Backups made
+    before journals existed are considered complete.
+    """
+
+    return (os.path.isfile(os.path.join(folder, *ManifestRelPath.split('/')))
+            or not os.path.isfile(os.path.join(folder, *JournalRelPath.split('/'))))
+
+
+class HashingFile():
+    """File wrapper computing the SHA-256 hash and size of the data read or written"""
+
+    def __init__(self, fileObj):
+
+        self._fileObj = fileObj
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+
+    def read(self, size=-1):
+
+        data = self._fileObj.read(size)
+        self._hash.update(data)
+        self.size += len(data)
+
+        return data
+
+
+    def write(self, data):
+
+        self._hash.update(data)
+        self.size += len(data)
+
+        return self._fileObj.write(data)
+
+
+    def hexdigest(self):
+
+        return self._hash.hexdigest()
+
+
+class Manifest():
+    """Size and SHA-256 hash of each file of a backup, by path
+
+    `documents` are the UUIDs of the documents and collections of a backup
+    limited to some collections, None if it contains all of them.
+    `excludes` are the patterns of the files that were left out, and
+    `skipTrash` tells if the documents in the trash were left out. Files can
+    be added from several threads.
+    """
+
+    def __init__(self, files=None, documents=None, excludes=None, skipTrash=False):
+
+        self.files = dict(files or {})
+        self.documents = documents
+        self.excludes = list(excludes or [])
+        self.skipTrash = skipTrash
+        self._lock = threading.Lock()
+
+
+    def add(self, relPath, size, digest):
+
+        with self._lock:
+            self.files[relPath] = (size, digest)
+
+
+    def toBytes(self):
+
+        with self._lock:
+            files = {path: {'size': size, 'sha256': digest}
+                     for path, (size, digest) in sorted(self.files.items())}
+
+        content = {'version': 1, 'files': files}
+        if self.documents is not None:
+            content['documents'] = sorted(self.documents)
+        if self.excludes:
+            content['excludes'] = self.excludes
+        if self.skipTrash:
+            content['skipTrash'] = True
+
+        return json.dumps(content, indent=1).encode('utf-8')
+
+
+    @classmethod
+    def fromBytes(cls, data):
+
+        content = json.loads(data.decode('utf-8'))
+
+        return cls({path: (attrs['size'], attrs['sha256'])
+                    for path, attrs in content['files'].items()},
+                   content.get('documents'), content.get('excludes'),
+                   content.get('skipTrash', False))
+
+
+    def save(self, folder):
+        """Writes the manifest in backup folder `folder`"""
+
+        metaDir = os.path.join(folder, constants.BackupMetaDirname)
+        os.makedirs(metaDir, exist_ok=True)
+        path = os.path.join(metaDir, constants.ManifestFilename)
+        with open(path + '.part', 'wb') as f:
+            f.write(self.toBytes())
+        os.replace(path + '.part', path)
+
+
+    @classmethod
+    def load(cls, backupPath):
+        """Reads the manifest of a backup folder or archive
+
+        Returns None if the backup has no manifest.
+        """
+
+        if os.path.isfile(backupPath):
+            data = archives.readFile(backupPath, ManifestRelPath)
+            if data is None:
+                return None
+        else:
+            path = os.path.join(backupPath, *ManifestRelPath.split('/'))
+            if not os.path.isfile(path):
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        return cls.fromBytes(data)
+
+
+class Index():
+    """Content and selection of a backup archive, written as its first member
+
+    A restore learns from it what the archive holds without reading it
+    whole. `entries` are the inventory entries of the files and folders of
+    the backup, in inventory order, and the other attributes are as in
+    Manifest.
+    """
+
+    def __init__(self, entries, documents=None, excludes=None, skipTrash=False):
+
+        self.entries = list(entries)
+        self.documents = documents
+        self.excludes = list(excludes or [])
+        self.skipTrash = skipTrash
+
+
+    def toBytes(self):
+
+        content = {'version': 1,
+                   'entries': [[entry.path, entry.isDir, entry.size, entry.mtime]
+                               for entry in self.entries]}
+        if self.documents is not None:
+            content['documents'] = sorted(self.documents)
+        if self.excludes:
+            content['excludes'] = self.excludes
+        if self.skipTrash:
+            content['skipTrash'] = True
+
+        return json.dumps(content).encode('utf-8')
+
+
+    @classmethod
+    def fromBytes(cls, data):
+
+        content = json.loads(data.decode('utf-8'))
+
+        return cls([inventory.Entry(*entry) for entry in content['entries']],
+                   content.get('documents'), content.get('excludes'),
+                   content.get('skipTrash', False))
+
+
+    @classmethod
+    def load(cls, archivePath):
+        """Reads the index of a backup archive
+
+        Returns None for archives made before indexes existed.
+        """
+
+        data = archives.readFile(archivePath, IndexRelPath, leading=True)
+        if data is None:
+            return None
+
+        return cls.fromBytes(data)
+
+
+class Journal():
+    """Record of the progress of a backup folder being written
+
+    The journal is a file of JSON lines. A "selection" record gives what the
+    backup contains, so that it is only resumed with the same selection. A
+    "start" record gives the size and modification time of a remote file
+    whose download starts, and a "done" record the same with the hash of the
+    saved file. Records are appended and flushed as files are processed, so
+    that an interrupted backup can be resumed. Files can be recorded from
+    several threads.
+    """
+
+    def __init__(self, folder):
+
+        metaDir = os.path.join(folder, constants.BackupMetaDirname)
+        os.makedirs(metaDir, exist_ok=True)
+        self._path = os.path.join(metaDir, constants.JournalFilename)
+        self._lock = threading.Lock()
+        # (size, mtime) by path
+        self.started = {}
+        # (size, mtime, digest) by path
+        self.done = {}
+        self.selection = None
+
+        if os.path.isfile(self._path):
+            with open(self._path, 'r+b') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('Incomplete line')
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # Last line cut by the interruption. It is removed so
+                        # that the records appended next can be read back.
+                        f.truncate(offset)
+                        break
+                    offset += len(line)
+                    if record['event'] == 'selection':
+                        self.selection = record['selection']
+                    elif record['event'] == 'start':
+                        self.started[record['path']] = (record['size'], record['mtime'])
+                    else:
+                        self.done[record['path']] = (record['size'], record['mtime'],
+                                                     record['sha256'])
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+
+    def _write(self, record):
+
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+
+    def setSelection(self, selection):
+        """Records the selection of the backup, a dictionary that can be saved as JSON"""
+
+        self.selection = selection
+        self._write({'event': 'selection', 'selection': selection})
+
+
+    def start(self, relPath, size, mtime):
+
+        self._write({'event': 'start', 'path': relPath, 'size': size, 'mtime': mtime})
+
+
+    def finish(self, relPath, size, mtime, digest):
+
+        self._write({'event': 'done', 'path': relPath, 'size': size, 'mtime': mtime,
+                     'sha256': digest})
+
+
+    def close(self):
+
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+    def remove(self):
+        """Deletes the journal once the backup is complete"""
+
+        self.close()
+        os.remove(self._path)
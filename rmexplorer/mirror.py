@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Record of the documents exported by the "mirror" download mode"""
+
+
+import os
+import json
+import threading
+import contextlib
+
+import rmexplorer.constants as constants
+import rmexplorer.tools as tools
+import rmexplorer.renderers as renderers
+
+
+class MirrorState():
+    """Remembers which revision of each document was exported to a folder
+
+    The record is stored as a JSON file at the root of the destination folder,
+    so that it follows the folder if it is moved.  Entries are kept separately
+    for each export mode.  Methods may be called from several threads.
+    """
+
+    def __init__(self, folder, mode):
+
+        self._folder = folder
+        self._mode = mode
+        self._path = os.path.join(folder, constants.MirrorStateFilename)
+        self._data = {'documents': {}}
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if (not isinstance(data, dict)
+                    or not isinstance(data.get('documents', {}), dict)
+                    or not isinstance(data.get('documents', {}).get(mode, {}), dict)):
+                raise ValueError('Unexpected content')
+            self._data = data
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            # Unreadable record: everything will be downloaded again.
+            pass
+        self._docs = self._data.setdefault('documents', {}).setdefault(mode, {})
+        self._lock = threading.Lock()
+
+
+    def isUpToDate(self, fid, stamp, destRelPath):
+        """Checks if a document revision was already exported to `destRelPath`
+
+        All the files of the export must still exist, which for PNG exports
+        means one file per page.
+        """
+
+        if stamp is None:
+            return False
+        with self._lock:
+            entry = self._docs.get(fid)
+        if not isinstance(entry, dict):
+            return False
+        if entry.get('stamp') != stamp or entry.get('path') != destRelPath:
+            return False
+        path = tools.exportPath(self._folder, destRelPath, self._mode)
+        if self._mode == 'png':
+            paths = renderers.pngPagePaths(path, entry.get('pages', 1))
+        else:
+            paths = [path]
+        return all(os.path.exists(path) for path in paths)
+
+
+    def record(self, fid, stamp, destRelPath, nPages=1):
+        """Remembers an export, of `nPages` files in PNG mode"""
+
+        if stamp is not None:
+            with self._lock:
+                self._docs[fid] = {'stamp': stamp, 'path': destRelPath, 'pages': nPages}
+
+
+    def save(self):
+
+        partPath = self._path + '.part'
+        try:
+            with open(partPath, 'w', encoding='utf-8') as f, self._lock:
+                json.dump(self._data, f, indent=1)
+            os.replace(partPath, self._path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(partPath)
+            raise
@@ -25,8 +25,10 @@
 """Qt dialog showing a progress bar"""
 
 
+import os
+
 from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QDialog, QProgressBar, QHBoxLayout
+from PyQt5.QtWidgets import QDialog, QProgressBar, QLabel, QVBoxLayout
 
 
 class ProgressWindow(QDialog):
@@ -43,12 +45,28 @@ class ProgressWindow(QDialog):
             self.progressBar.setFormat('%v')
         self.progressBar.setMinimum(0)
 
-        mainLayout = QHBoxLayout()
+        # Optional line of text below the progress bar, e.g. the name of the
+        # last processed file.
+        self.label = QLabel(self)
+        self.label.hide()
+
+        # Optional progress bar for the bytes of the file being transferred
+        self.fileProgressBar = QProgressBar(self)
+        self.fileProgressBar.setMinimum(0)
+        self.fileProgressBar.hide()
+
+        mainLayout = QVBoxLayout()
         mainLayout.addWidget(self.progressBar)
+        mainLayout.addWidget(self.label)
+        mainLayout.addWidget(self.fileProgressBar)
         self.setLayout(mainLayout)
 
         self.step = 0
         self.nSteps = 1
+        # Name of the file shown by fileProgressBar.  When several files are
+        # transferred at once, the bar sticks to one file until it completes.
+        self._shownFile = None
+        self._shownFileDone = True
 
 
     def refresh(self):
@@ -86,3 +104,34 @@ class ProgressWindow(QDialog):
         if not self._knownEndVal:
             self.nSteps = step
         self.refresh()
+
+
+    def updateText(self, text):
+
+        self.label.setText(text)
+        self.label.show()
+
+
+    def updateFileProgress(self, name, received, total):
+        """Shows the progress within a single file
+
+        `total` is 0 when the size of the file is not known in advance.
+        """
+
+        if name != self._shownFile:
+            if not self._shownFileDone:
+                return
+            self._shownFile = name
+        self._shownFileDone = total > 0 and received >= total
+        self.fileProgressBar.setMaximum(max(total, 1) // 1024 if total else 0)
+        self.fileProgressBar.setValue(received // 1024)
+        self.fileProgressBar.setFormat('%s: %.1f MB' % (os.path.basename(name),
+                                                        received / 1e6))
+        self.fileProgressBar.show()
+
+
+    def fileDone(self, name):
+
+        if name == self._shownFile:
+            self._shownFileDone = True
+        self.updateText(name)
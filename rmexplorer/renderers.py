@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""PDF rasterizers used for the PNG export"""
+
+
+import os
+import re
+import shutil
+import tempfile
+import subprocess
+import importlib.util
+
+
+def pngPagePaths(destPath, nPages):
+    """Returns the paths of the PNG files of a document with `nPages` pages
+
+    Names follow those written by ImageMagick for a stack of images: a
+    single page is saved to `destPath` while pages of longer documents get a
+    "-<index>" suffix starting at 0.
+    """
+
+    if nPages == 1:
+        return [destPath]
+    base, ext = os.path.splitext(destPath)
+    return ['%s-%d%s' % (base, i, ext) for i in range(nPages)]
+
+
+class Renderer():
+    """Base class of the rasterizer backends
+
+    Backends render and write one page at a time, so that memory usage does
+    not depend on the number of pages.
+    """
+
+    name = None
+    description = None
+
+
+    @classmethod
+    def isAvailable(cls):
+
+        raise NotImplementedError()
+
+
+    def pageCount(self, pdfPath):
+
+        raise NotImplementedError()
+
+
+    def renderPage(self, pdfPath, index, pngPath, resolution):
+
+        raise NotImplementedError()
+
+
+    def render(self, pdfPath, destPath, resolution):
+        """Converts a PDF file to a stack of PNG files and returns their paths"""
+
+        paths = pngPagePaths(destPath, self.pageCount(pdfPath))
+        for i, path in enumerate(paths):
+            self.renderPage(pdfPath, i, path, resolution)
+        return paths
+
+
+class PyMuPDFRenderer(Renderer):
+
+    name = 'pymupdf'
+    description = 'PyMuPDF'
+
+
+    @classmethod
+    def isAvailable(cls):
+
+        return (importlib.util.find_spec('pymupdf') is not None
+                or importlib.util.find_spec('fitz') is not None)
+
+
+    @staticmethod
+    def _module():
+
+        # Older versions of PyMuPDF only provide the "fitz" module name.
+        try:
+            import pymupdf
+        except ImportError:
+            import fitz as pymupdf
+        return pymupdf
+
+
+    @staticmethod
+    def _renderPage(pymupdf, page, pngPath, resolution):
+
+        # A zoom matrix rather than the dpi argument, which older versions
+        # do not have
+        zoom = resolution / 72
+        page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom)).save(pngPath)
+
+
+    def pageCount(self, pdfPath):
+
+        with self._module().open(pdfPath) as doc:
+            return len(doc)
+
+
+    def renderPage(self, pdfPath, index, pngPath, resolution):
+
+        pymupdf = self._module()
+        with pymupdf.open(pdfPath) as doc:
+            self._renderPage(pymupdf, doc[index], pngPath, resolution)
+
+
+    def render(self, pdfPath, destPath, resolution):
+
+        # The document is opened once for all its pages
+        pymupdf = self._module()
+        with pymupdf.open(pdfPath) as doc:
+            paths = pngPagePaths(destPath, len(doc))
+            for page, path in zip(doc, paths):
+                self._renderPage(pymupdf, page, path, resolution)
+        return paths
+
+
+class PdftoppmRenderer(Renderer):
+
+    name = 'pdftoppm'
+    description = 'Poppler (pdftoppm)'
+
+    # Avoids console windows popping up from the GUI executable on Windows
+    _creationFlags = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+
+
+    @classmethod
+    def isAvailable(cls):
+
+        return bool(shutil.which('pdftoppm') and shutil.which('pdfinfo'))
+
+
+    def pageCount(self, pdfPath):
+
+        res = subprocess.run(['pdfinfo', pdfPath],
+                             capture_output=True, check=True,
+                             creationflags=self._creationFlags)
+        m = re.search(rb'^Pages:\s*(\d+)', res.stdout, re.MULTILINE)
+        if m is None:
+            raise RuntimeError('Could not read the number of pages of "%s".' % pdfPath)
+        return int(m.group(1))
+
+
+    def renderPage(self, pdfPath, index, pngPath, resolution):
+
+        # pdftoppm appends the extension to the output root
+        root = os.path.splitext(pngPath)[0]
+        subprocess.run(['pdftoppm', '-png', '-r', str(resolution),
+                        '-f', str(index + 1), '-l', str(index + 1),
+                        '-singlefile', pdfPath, root],
+                       capture_output=True, check=True,
+                       creationflags=self._creationFlags)
+
+
+    def render(self, pdfPath, destPath, resolution):
+
+        # A single pdftoppm process parses the PDF once for all the pages. It
+        # writes them to "<root>-<number>.png", with the number padded with
+        # zeros, in a temporary folder from which they are renamed.
+        tmpDir = tempfile.mkdtemp(dir=os.path.dirname(destPath) or None,
+                                  prefix='.pdftoppm')
+        try:
+            subprocess.run(['pdftoppm', '-png', '-r', str(resolution),
+                            pdfPath, os.path.join(tmpDir, 'page')],
+                           capture_output=True, check=True,
+                           creationflags=self._creationFlags)
+            pages = sorted((int(m.group(1)), name) for name in os.listdir(tmpDir)
+                           for m in [re.match(r'^page-(\d+)\.png$', name)] if m)
+            paths = pngPagePaths(destPath, len(pages))
+            for (_, name), path in zip(pages, paths):
+                os.replace(os.path.join(tmpDir, name), path)
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        return paths
+
+
+class WandRenderer(Renderer):
+
+    name = 'wand'
+    description = 'ImageMagick (Wand)'
+
+
+    @classmethod
+    def isAvailable(cls):
+
+        # Wand raises ImportError when the ImageMagick library is missing.
+        try:
+            import wand.image
+        except ImportError:
+            return False
+        return True
+
+
+    def pageCount(self, pdfPath):
+
+        import wand.image
+
+        # Pinging reads the page count without rasterizing the pages.
+        with wand.image.Image(filename=pdfPath, ping=True) as img:
+            return len(img.sequence)
+
+
+    def renderPage(self, pdfPath, index, pngPath, resolution):
+
+        import wand.image
+
+        # The "[index]" suffix makes ImageMagick (and Ghostscript) read only
+        # that page.
+        with wand.image.Image(filename='%s[%d]' % (pdfPath, index),
+                              resolution=resolution) as img:
+            with img.convert('png') as converted:
+                converted.save(filename=pngPath)
+
+
+# Backends, fastest first
+Renderers = (PyMuPDFRenderer, PdftoppmRenderer, WandRenderer)
+
+
+def getRenderer(name='auto'):
+    """Returns an instance of the backend called `name`
+
+    'auto' selects the fastest available backend.
+    """
+
+    if name == 'auto':
+        for cls in Renderers:
+            if cls.isAvailable():
+                return cls()
+        raise RuntimeError('No PDF renderer found. Install PyMuPDF, Poppler or ImageMagick.')
+    for cls in Renderers:
+        if cls.name == name:
+            if not cls.isAvailable():
+                raise RuntimeError('PDF renderer "%s" is not available.' % cls.description)
+            return cls()
+    raise ValueError('Unknown PDF renderer "%s".' % name)
+
+
+def renderPng(pdfPath, destPath, resolution, rendererName='auto'):
+    """Converts a PDF file to a stack of PNG files and returns their paths
+
+    This is CPU-bound and does not need the settings, so that it can run in
+    a process pool.
+    """
+
+    return getRenderer(rendererName).render(pdfPath, destPath, resolution)
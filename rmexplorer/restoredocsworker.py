@@ -30,6 +30,14 @@ import errno
 import stat
 import posixpath
 import socket
+import threading
+import contextlib
+import tempfile
+import shutil
+import shlex
+import tarfile
+import hashlib
+import itertools
 import paramiko
 
 from PyQt5.QtCore import QObject
@@ -37,8 +45,14 @@ from PyQt5.QtCore import QObject
 # mature enough.
 from PyQt5.QtCore import pyqtSignal as Signal
 
+import rmexplorer.constants as constants
 import rmexplorer.tools as tools
+import rmexplorer.inventory as inventory
+import rmexplorer.archives as archives
+import rmexplorer.manifest as manifest
+import rmexplorer.selection as selection
 from rmexplorer.settings import Settings
+from rmexplorer.sftppool import SftpPool
 
 
 class RestoreDocsWorker(QObject):
@@ -49,59 +63,499 @@ class RestoreDocsWorker(QObject):
     finished = Signal()
 
 
-    def __init__(self, srcFolder, masterKey):
+    def __init__(self, srcFolder, masterKey, docIds=None):
+        """`srcFolder` is a backup folder or a backup archive
+
+        If `docIds` is given, only the documents or collections with these
+        UUIDs are restored, and the other files on the tablet are left
+        untouched. The same applies to a backup limited to some collections.
+        """
 
         super().__init__()
 
         self._settings = Settings(masterKey)
         self._srcFolder = srcFolder
+        self._docIds = None if docIds is None else set(docIds)
+        # Patterns of the files left out of the backup, kept on the tablet
+        self._excludes = []
+        # Whether the documents in the trash were left out of the backup, and
+        # are kept on the tablet
+        self._keepTrash = False
+        self._count = 0
+        self._countLock = threading.Lock()
+        # Files of a staging folder can be hard links to the live documents
+        self._unlinkBeforePut = False
+        # Block hashes of the remote files to transfer by blocks, by path
+        self._deltaBlocks = {}
 
 
-    def _countElems(self, path):
-        """Returns the number of files and folders in a local directory"""
-
-        return sum([len(files) + len(dirs) for _, dirs, files in os.walk(path)])
-
+    def _removeEntries(self, sftpClient, entries, dirPath):
+        """Deletes remote files and folders
 
-    def _rmDir(self, sftpClient, dirPath):
-        """Deletes remote directory `path`"""
+        `entries` are inventory entries of remote directory `dirPath`, in
+        inventory order, and must include the content of the folders to
+        delete.
+        """
 
-        for f in sftpClient.listdir_attr(dirPath):
-            path = posixpath.join(dirPath, f.filename)
-            if stat.S_ISDIR(f.st_mode):
-                self._rmDir(sftpClient, path)
+        # Folders are listed before their content, so the reverse order empties
+        # each folder before removing it.
+        for entry in reversed(entries):
+            path = posixpath.join(dirPath, entry.path)
+            if entry.isDir:
+                sftpClient.rmdir(path)
             else:
                 sftpClient.remove(path)
-        sftpClient.rmdir(dirPath)
+            self._step()
+
+
+    def _removeEntriesRemotely(self, ssh, entries, dirPath):
+        """Deletes remote files and folders with a single command
+
+        Same as `_removeEntries`, without a round trip per entry.
+        """
+
+        paths = {entry.path for entry in entries}
+        # Removing a folder removes its content
+        topPaths = [entry.path for entry in entries
+                    if posixpath.dirname(entry.path) not in paths]
+        if topPaths:
+            command = 'cd %s && xargs -0 rm -rf --' % shlex.quote(dirPath)
+            stdin = b''.join(path.encode('utf-8', 'surrogateescape') + b'\0'
+                             for path in topPaths)
+            status, _, err = tools.runCommand(ssh, command, stdin)
+            if status != 0:
+                raise Exception('Cannot delete files on the tablet: %s'
+                                % err.decode('utf-8', 'replace').strip())
+        for _ in entries:
+            self._step()
+
+
+    def _isSelected(self, path):
+        """Tells if a path relative to the documents folder belongs to the documents to restore"""
+
+        if self._docIds is None:
+            return True
+
+        return selection.documentId(path) in self._docIds
+
+
+    def _restartInterface(self, ssh):
+        """Restarts xochitl so that it shows the restored documents"""
+
+        status, _, err = tools.runCommand(ssh, 'systemctl restart xochitl')
+        if status != 0:
+            raise Exception("The documents were restored but the tablet's interface could not be restarted: %s\nPlease reboot the tablet."
+                            % err.decode('utf-8', 'replace').strip())
+
+
+    def _step(self):
+        """Counts one more element as processed"""
+
+        with self._countLock:
+            self._count += 1
+            self.notifyProgress.emit(self._count)
+
+
+    @staticmethod
+    def _putFile(sftpClient, src, destPath, mtime, unlink=False):
+        """Uploads a local path or a file object, giving it the modification time of the backup
+
+        If `unlink` is True, an existing remote file is removed first instead
+        of being overwritten in place.
+        """
+
+        if unlink:
+            try:
+                sftpClient.remove(destPath)
+            except FileNotFoundError:
+                pass
+        if isinstance(src, str):
+            sftpClient.put(src, destPath)
+        else:
+            sftpClient.putfo(src, destPath)
+        # Lets a later differential restore tell that the file is up to date
+        sftpClient.utime(destPath, (mtime, mtime))
+
 
+    @staticmethod
+    def _patchFile(sftpClient, src, destPath, mtime, remoteBlocks):
+        """Uploads the blocks of a local path or a file object that differ from the remote file
 
-    def _recursiveUpload(self, sftpClient, root, destRoot, count=0):
-        """Recursively copies a local folder to a remote location"""
+        `remoteBlocks` are the block hashes of remote file `destPath`, as
+        returned by `inventory.remoteBlockHashes`. The remote file is written
+        in place and truncated to the size of the source.
+        """
 
-        for name in os.listdir(root):
-            count += 1
-            self.notifyProgress.emit(count)
-            path = os.path.join(root, name)
-            destPath = posixpath.join(destRoot, name)
-            if os.path.isdir(path):
+        with contextlib.ExitStack() as stack:
+            if isinstance(src, str):
+                src = stack.enter_context(open(src, 'rb'))
+            remoteFile = stack.enter_context(sftpClient.open(destPath, 'r+b'))
+            size = 0
+            for i in itertools.count():
+                block = src.read(constants.DeltaBlockSize)
+                if not block:
+                    break
+                if i >= len(remoteBlocks) or hashlib.md5(block).hexdigest() != remoteBlocks[i]:
+                    remoteFile.seek(size)
+                    remoteFile.write(block)
+                size += len(block)
+            remoteFile.flush()
+            remoteFile.truncate(size)
+        sftpClient.utime(destPath, (mtime, mtime))
+
+
+    def _submitPut(self, sftpPool, src, path, destPath, mtime):
+        """Queues the upload of a local path or a file object on `sftpPool`"""
+
+        if path in self._deltaBlocks:
+            return sftpPool.submit(self._patchFile, src, destPath, mtime,
+                                   self._deltaBlocks[path])
+
+        return sftpPool.submit(self._putFile, src, destPath, mtime,
+                               self._unlinkBeforePut)
+
+
+    def _upload(self, sftpClient, sftpPool, entries, root, destRoot, futures,
+                isUpToDate=None):
+        """Copies a local folder to a remote location
+
+        `entries` is the inventory of local folder `root`. Folders are created
+        in order with `sftpClient` so that they exist before any file is
+        written in them, while files are queued on `sftpPool`. Each file's
+        future is added to `futures`. If given, `isUpToDate(entry, path)`
+        tells if a file or folder is already present on the tablet and can be
+        skipped.
+        """
+
+        for entry in entries:
+            destPath = posixpath.join(destRoot, entry.path)
+            path = os.path.join(root, *entry.path.split('/'))
+            if isUpToDate is not None and isUpToDate(entry, path):
+                self._step()
+            elif entry.isDir:
                 sftpClient.mkdir(destPath)
-                count = self._recursiveUpload(sftpClient,
-                                              path,
-                                              destPath,
-                                              count)
+                self._step()
+            else:
+                future = self._submitPut(sftpPool, path, entry.path, destPath, entry.mtime)
+                future.add_done_callback(lambda future: self._step())
+                futures[future] = path
+
+
+    @staticmethod
+    def _spool(fileObj):
+        """Copies a file object of an archive to a temporary file, so that it can be read again
+
+        The temporary file is held in memory for small files only.
+        """
+
+        spool = tempfile.SpooledTemporaryFile(max_size=constants.SpoolMaxSize)
+        shutil.copyfileobj(fileObj, spool, constants.SSHChunkSize)
+        spool.seek(0)
+
+        return spool
+
+
+    @staticmethod
+    def _archiveFiles(archivePath, entries):
+        """Yields the files to restore of a backup archive as `archives.iterFiles`
+
+        Only the files in `entries`, the entries to restore, are yielded, which
+        skips the backup metadata and the documents that are not restored.
+        """
+
+        paths = {entry.path for entry in entries if not entry.isDir}
+        for entry, fileObj in archives.iterFiles(archivePath):
+            if entry.path in paths:
+                yield entry, fileObj
+
+
+    def _uploadArchive(self, sftpClient, sftpPool, entries, archivePath, destRoot, futures,
+                       isUpToDate=None):
+        """Copies the content of a backup archive to a remote location
+
+        `entries` is the inventory of the archive. The archive is read in a
+        single pass, and files are queued on `sftpPool` as they are read. Each
+        file's future is added to `futures`. If given, `isUpToDate(entry,
+        fileObj)` tells if a file or folder is already present on the tablet
+        and can be skipped, `fileObj` giving the content of files.
+        """
+
+        for entry in entries:
+            if not entry.isDir:
+                continue
+            if isUpToDate is None or not isUpToDate(entry, None):
+                sftpClient.mkdir(posixpath.join(destRoot, entry.path))
+            self._step()
+
+        # Bounds the number of files spooled while waiting for a channel
+        slots = threading.BoundedSemaphore(2 * self._settings.value('SFTPChannels', type=int))
+
+        for entry, fileObj in self._archiveFiles(archivePath, entries):
+            slots.acquire()
+            spool = self._spool(fileObj)
+            if isUpToDate is not None and isUpToDate(entry, spool):
+                spool.close()
+                slots.release()
+                self._step()
+                continue
+            spool.seek(0)
+            destPath = posixpath.join(destRoot, entry.path)
+
+            def done(future, spool=spool):
+                spool.close()
+                slots.release()
+                self._step()
+
+            future = self._submitPut(sftpPool, spool, entry.path, destPath, entry.mtime)
+            future.add_done_callback(done)
+            futures[future] = entry.path
+
+
+    def _tarUpload(self, ssh, entries, src, isArchive, destRoot, isUpToDate=None):
+        """Copies a backup to a remote location as a single tar stream
+
+        The tar stream is generated locally from backup folder or archive
+        `src`, whose inventory is `entries`, and extracted on the tablet with
+        one `tar` command. `isUpToDate` is as in `_upload` and
+        `_uploadArchive`.
+        """
+
+        # tar removes existing files before extracting them, so hard links of
+        # a staging folder are never written through.
+
+        compress = self._settings.value('TarCompression', type=bool)
+        command = 'tar x%sf - -C %s' % ('z' if compress else '',
+                                         shlex.quote(destRoot))
+        chanIn, chanOut, chanErr = ssh.exec_command(command,
+                                                    timeout=constants.SSHTimeout)
+
+        def tarInfo(entry):
+            info = tarfile.TarInfo(entry.path)
+            info.mtime = entry.mtime
+            if entry.isDir:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+            else:
+                info.size = entry.size
+                info.mode = 0o644
+            return info
+
+        with tarfile.open(fileobj=chanIn, mode='w|gz' if compress else 'w|') as tar:
+            for entry in entries:
+                if entry.isDir:
+                    if isUpToDate is None or not isUpToDate(entry, None):
+                        tar.addfile(tarInfo(entry))
+                    self._step()
+            if isArchive:
+                for entry, fileObj in self._archiveFiles(src, entries):
+                    if isUpToDate is None:
+                        tar.addfile(tarInfo(entry), fileObj)
+                    else:
+                        # The content is read twice when it is compared
+                        with self._spool(fileObj) as spool:
+                            if not isUpToDate(entry, spool):
+                                spool.seek(0)
+                                tar.addfile(tarInfo(entry), spool)
+                    self._step()
             else:
-                sftpClient.put(path, destPath)
+                for entry in entries:
+                    if entry.isDir:
+                        continue
+                    path = os.path.join(src, *entry.path.split('/'))
+                    if isUpToDate is None or not isUpToDate(entry, path):
+                        with open(path, 'rb') as f:
+                            tar.addfile(tarInfo(entry), f)
+                    self._step()
+        chanIn.channel.shutdown_write()
+
+        err = chanErr.read()
+        if chanOut.channel.recv_exit_status() != 0:
+            raise Exception('tar: %s' % err.decode('utf-8', 'replace').strip())
+
+
+    def _differentialChecker(self, ssh, entries, remoteEntries, destDir, isArchive):
+        """Compares the backup with the remote tree
+
+        `entries` and `remoteEntries` are the inventories of the backup and of
+        remote folder `destDir`. Returns the remote entries to delete, being
+        extra or of a different type than in the backup, and a function for
+        the `isUpToDate` argument of the upload methods. Files are compared
+        by size and modification time, or by size and SHA-256 hash if the
+        RestoreCompareHashes setting is set.
+        """
+
+        local = {entry.path: entry for entry in entries}
+        remote = {entry.path: entry for entry in remoteEntries}
+        toDelete = [entry for entry in remoteEntries
+                    if entry.path not in local
+                    or local[entry.path].isDir != entry.isDir]
+        deleted = {entry.path for entry in toDelete}
+
+        compareHashes = self._settings.value('RestoreCompareHashes', type=bool)
+        hashes = {}
+        if compareHashes:
+            candidates = [entry.path for entry in entries
+                          if not entry.isDir and entry.path in remote
+                          and entry.path not in deleted
+                          and remote[entry.path].size == entry.size]
+            hashes = inventory.remoteHashes(ssh, destDir, candidates)
+
+        def isUpToDate(entry, content):
+            """`content` is the local path of a file, a file object, or None for folders"""
+
+            if entry.path not in remote or entry.path in deleted:
+                return False
+            if entry.isDir:
+                return True
+            remoteEntry = remote[entry.path]
+            if remoteEntry.size != entry.size:
+                return False
+            if not compareHashes:
+                return int(remoteEntry.mtime) == int(entry.mtime)
+            if entry.path not in hashes:
+                return False
+            if isArchive:
+                digest = inventory.fileHash(content)
+            else:
+                with open(content, 'rb') as f:
+                    digest = inventory.fileHash(f)
+            return digest == hashes[entry.path]
+
+        return toDelete, isUpToDate
+
+
+    def _remoteBlocks(self, ssh, entries, remoteEntries, toDelete, destDir):
+        """Returns the block hashes of the remote files that can be updated by blocks
+
+        These are the large files of the backup that exist on the tablet and
+        may differ, `toDelete` being the remote entries that will be deleted.
+        The returned dictionary maps their paths to their block hashes.
+        """
+
+        remote = {entry.path: entry for entry in remoteEntries}
+        deleted = {entry.path for entry in toDelete}
+        compareHashes = self._settings.value('RestoreCompareHashes', type=bool)
+        candidates = [entry.path for entry in entries
+                      if not entry.isDir and entry.path in remote
+                      and entry.path not in deleted
+                      and entry.size >= constants.DeltaMinFileSize
+                      and (compareHashes
+                           or remote[entry.path].size != entry.size
+                           or int(remote[entry.path].mtime) != int(entry.mtime))]
+        blocks = inventory.remoteBlockHashes(ssh, destDir, candidates)
+
+        # Files whose hashes were not all received are uploaded in full
+        return {path: hashes for path, hashes in blocks.items()
+                if path in remote
+                and len(hashes) == -(-remote[path].size // constants.DeltaBlockSize)}
+
+
+    def _unshareFiles(self, ssh, dirPath, paths):
+        """Replaces remote files with copies, so that they can be written in place
+
+        This keeps files of a staging folder that are hard links to the live
+        documents from being modified through the link.
+        """
+
+        if not paths:
+            return
+
+        script = 'cp -p -- "$1" "$1.tmp" && mv -f -- "$1.tmp" "$1"'
+        command = 'cd %s && xargs -0 -n 1 sh -c %s _' % (shlex.quote(dirPath),
+                                                         shlex.quote(script))
+        stdin = b''.join(path.encode('utf-8', 'surrogateescape') + b'\0'
+                         for path in paths)
+        status, _, err = tools.runCommand(ssh, command, stdin)
+        if status != 0:
+            raise Exception('Cannot copy files in the staging folder: %s'
+                            % err.decode('utf-8', 'replace').strip())
+
+
+    @staticmethod
+    def _stagingPaths(destDir):
+        """Returns the remote staging folder and the folder for the previous documents"""
+
+        destDir = destDir.rstrip('/')
+
+        return (destDir + constants.RestoreStagingSuffix,
+                destDir + constants.RestoreOldSuffix)
+
+
+    def _prepareStaging(self, ssh, destDir, seed):
+        """Creates the remote staging folder next to `destDir`
+
+        If `seed` is True, the staging folder starts as a copy of `destDir`
+        made of hard links, which takes no space and lets a differential
+        restore only upload what differs. Otherwise it starts empty.
+        """
+
+        stagingDir, oldDir = self._stagingPaths(destDir)
+        # Leftovers of an interrupted restore are discarded
+        command = 'rm -rf -- %s %s && ' % (shlex.quote(stagingDir), shlex.quote(oldDir))
+        if seed:
+            command += 'cp -al -- %s %s' % (shlex.quote(destDir), shlex.quote(stagingDir))
+        else:
+            command += 'mkdir -- %s' % shlex.quote(stagingDir)
+        status, _, err = tools.runCommand(ssh, command)
+        if status != 0:
+            raise Exception('Cannot create the staging folder on the tablet: %s'
+                            % err.decode('utf-8', 'replace').strip())
+
+        return stagingDir
+
+
+    def _swapStaging(self, ssh, destDir):
+        """Replaces `destDir` with the staging folder and restarts the tablet's interface
+
+        The interface is stopped only for the two renames, and the previous
+        documents are put back if the staging folder cannot be moved.
+        """
 
-        return count
+        stagingDir, oldDir = self._stagingPaths(destDir)
+        dest, staging, old = (shlex.quote(path) for path in (destDir, stagingDir, oldDir))
+        command = ('systemctl stop xochitl; '
+                   'if mv -- {dest} {old}; then '
+                   'if mv -- {staging} {dest}; then status=0; '
+                   'else mv -- {old} {dest}; status=1; fi; '
+                   'else status=1; fi; '
+                   'systemctl start xochitl; '
+                   'if [ $status -eq 0 ]; then rm -rf -- {old}; fi; '
+                   'exit $status').format(dest=dest, staging=staging, old=old)
+        status, _, err = tools.runCommand(ssh, command)
+        if status != 0:
+            raise Exception('Cannot replace the documents folder with the staging folder "%s": %s'
+                            % (stagingDir, err.decode('utf-8', 'replace').strip()))
+        self._step()
 
 
     def start(self):
 
         try:
-            with tools.openSftp(self._settings) as sftp:
+            with tools.openSsh(self._settings) as ssh, contextlib.closing(ssh.open_sftp()) as sftp:
                 destDir = self._settings.value('TabletDocumentsDir', type=str)
-                nFiles = self._countElems(self._srcFolder)
-                self.notifyNSteps.emit(nFiles)
+                isArchive = os.path.isfile(self._srcFolder)
+                # Compressed archives are only read whole once, when the
+                # files are uploaded, if they start with an index.
+                index = manifest.Index.load(self._srcFolder) if isArchive else None
+                if index is not None:
+                    backupManifest = index
+                    entries = index.entries
+                else:
+                    backupManifest = manifest.Manifest.load(self._srcFolder)
+                    if isArchive:
+                        entries = archives.listArchive(self._srcFolder)
+                    else:
+                        entries = inventory.localInventory(self._srcFolder)
+                if backupManifest is not None:
+                    if self._docIds is None and backupManifest.documents is not None:
+                        self._docIds = set(backupManifest.documents)
+                    self._excludes = backupManifest.excludes
+                    self._keepTrash = backupManifest.skipTrash
+                entries = [entry for entry in entries
+                           if not manifest.isMetadata(entry.path)
+                           and self._isSelected(entry.path)]
+                if not entries:
+                    raise Exception('The documents to restore are not in the backup.')
                 try:
                     attr = sftp.lstat(destDir)
                 except FileNotFoundError:
@@ -111,11 +565,61 @@ class RestoreDocsWorker(QObject):
                                             destDir)
                 if not stat.S_ISDIR(attr.st_mode):
                     raise Exception('Remote path "%s" is not a folder.' % destDir)
-                self._rmDir(sftp, destDir)
-                sftp.mkdir(destDir)
-                self._recursiveUpload(sftp,
-                                      self._srcFolder,
-                                      destDir)
+                remoteEntries = [entry for entry in inventory.remoteInventory(ssh, sftp, destDir)
+                                 if self._isSelected(entry.path)
+                                 and not selection.isExcluded(entry.path, self._excludes)]
+                if self._keepTrash:
+                    trashed = selection.trashedDocuments(inventory.remoteMetadata(ssh, destDir))
+                    remoteEntries = [entry for entry in remoteEntries
+                                     if selection.documentId(entry.path) not in trashed]
+                differential = self._settings.value('DifferentialRestore', type=bool)
+                if differential:
+                    toDelete, isUpToDate = self._differentialChecker(ssh, entries, remoteEntries,
+                                                                     destDir, isArchive)
+                else:
+                    toDelete, isUpToDate = remoteEntries, None
+                useTar = self._settings.value('RestoreMethod', type=str) == 'tar'
+                if (differential and not useTar
+                        and self._settings.value('DeltaTransfer', type=bool)):
+                    self._deltaBlocks = self._remoteBlocks(ssh, entries, remoteEntries,
+                                                           toDelete, destDir)
+                # Staging all the documents is not worth it for a few of them
+                staged = (self._docIds is None
+                          and self._settings.value('StagedRestore', type=bool))
+                uploadDir = destDir
+                if staged:
+                    # The documents stay in place until the upload is complete.
+                    # Files left out of the backup must be kept, so staging
+                    # then starts as a copy of the documents from which the
+                    # other files are deleted.
+                    seed = differential or bool(self._excludes) or self._keepTrash
+                    uploadDir = self._prepareStaging(ssh, destDir, seed)
+                    self._unlinkBeforePut = seed
+                    self._unshareFiles(ssh, uploadDir, sorted(self._deltaBlocks))
+                    if not seed:
+                        toDelete = []
+                self.notifyNSteps.emit(len(toDelete) + len(entries) + (1 if staged else 0))
+                if useTar:
+                    self._removeEntriesRemotely(ssh, toDelete, uploadDir)
+                    self._tarUpload(ssh, entries, self._srcFolder, isArchive,
+                                    uploadDir, isUpToDate)
+                else:
+                    self._removeEntries(sftp, toDelete, uploadDir)
+                    futures = {}
+                    with SftpPool(ssh, self._settings.value('SFTPChannels', type=int)) as sftpPool:
+                        if isArchive:
+                            self._uploadArchive(sftp, sftpPool, entries, self._srcFolder,
+                                                uploadDir, futures, isUpToDate)
+                        else:
+                            self._upload(sftp, sftpPool, entries, self._srcFolder,
+                                         uploadDir, futures, isUpToDate)
+                    for future in futures:
+                        if future.exception() is not None:
+                            raise future.exception()
+                if staged:
+                    self._swapStaging(ssh, destDir)
+                elif self._docIds is not None:
+                    self._restartInterface(ssh)
         except FileNotFoundError as e:
             self.error.emit(str(e))
         except socket.timeout:
@@ -26,12 +26,14 @@
 
 
 import os
+import time
 import socket
-import json
-import urllib.request
 import urllib.error
 
 from PyQt5.QtCore import Qt, QThread
+# Renaming below is to prepare for switch from PyQt5 to PySide2 when it will be
+# mature enough.
+from PyQt5.QtCore import pyqtSignal as Signal
 from PyQt5.QtWidgets import (qApp, QWidget, QMainWindow, QMenu, QAction,
                              QLabel, QListWidget, QGridLayout, QVBoxLayout,
                              QDialog, QFileDialog, QMessageBox,
@@ -41,22 +43,34 @@ import rmexplorer.constants as constants
 from rmexplorer._version import __version__
 from rmexplorer.saveoptsdialog import SaveOptsDialog
 from rmexplorer.settingsdialog import SettingsDialog
+from rmexplorer.listdirworker import ListDirWorker
 from rmexplorer.downloadfilesworker import DownloadFilesWorker
 from rmexplorer.uploaddocsworker import UploadDocsWorker
 from rmexplorer.backupdocsworker import BackupDocsWorker
 from rmexplorer.restoredocsworker import RestoreDocsWorker
+from rmexplorer.verifybackupworker import VerifyBackupWorker
+from rmexplorer.indexbackupsworker import IndexBackupsWorker
+from rmexplorer.catalogdialog import CatalogDialog
 from rmexplorer.progresswindow import ProgressWindow
 from rmexplorer.settings import Settings
+from rmexplorer.treecache import TreeCache
+from rmexplorer.catalog import SnapshotCatalog
 import rmexplorer.tools as tools
 
 
 class RmExplorerWindow(QMainWindow):
 
+    listDirRequested = Signal(str, object)
+    prefetchRequested = Signal(list)
+
+
     def __init__(self):
 
         super().__init__()
 
         self.settings = Settings()
+        self.treeCache = TreeCache()
+        self.catalog = SnapshotCatalog()
         self.updateFromSettings()
 
         self.statusBar()
@@ -97,7 +111,23 @@ class RmExplorerWindow(QMainWindow):
         self.dirIds = []
         self.dirNames = []
         self.fileIds = []
-        self.goToDir('', '')
+        self.fileStamps = []
+        self.pendingDir = None
+        # Listings received during the session, as (time, data) tuples
+        self.listings = {}
+
+        self.listDirWorker = ListDirWorker(self.treeCache)
+        self.listThread = QThread()
+        self.listDirWorker.moveToThread(self.listThread)
+        self.listDirRequested.connect(self.listDirWorker.listDir)
+        self.prefetchRequested.connect(self.listDirWorker.prefetch)
+        self.listDirWorker.listed.connect(self.onDirListed)
+        self.listDirWorker.failed.connect(self.onListDirFailed)
+        self.listThread.start()
+
+        # Show the last known contents of the root, if any, without waiting
+        # for the tablet.
+        self.goToDir('', '', allowStale=True)
 
         self.currentWarning = ''
         self.hasRaised = None
@@ -107,6 +137,8 @@ class RmExplorerWindow(QMainWindow):
         self.uploadDocsWorker = None
         self.backupDocsWorker = None
         self.restoreDocsWorker = None
+        self.verifyBackupWorker = None
+        self.indexBackupsWorker = None
         self.taskThread = None
 
         self._masterKey = None
@@ -172,9 +204,31 @@ class RmExplorerWindow(QMainWindow):
         restoreDocsAct.setStatusTip('Restore documents on the tablet from a backup on this computer.')
         restoreDocsAct.triggered.connect(self.restoreDocs)
         #
+        restoreArchiveAct = QAction('Restore documents from &archive', self)
+        restoreArchiveAct.setStatusTip('Restore documents on the tablet from a backup archive on this computer.')
+        restoreArchiveAct.triggered.connect(self.restoreDocsFromArchive)
+        #
+        verifyBackupAct = QAction('&Verify backup', self)
+        verifyBackupAct.setStatusTip('Check a backup on this computer against its manifest and the documents on the tablet.')
+        verifyBackupAct.triggered.connect(self.verifyBackup)
+        #
+        verifyArchiveAct = QAction('Verify backup ar&chive', self)
+        verifyArchiveAct.setStatusTip('Check a backup archive on this computer against its manifest and the documents on the tablet.')
+        verifyArchiveAct.triggered.connect(self.verifyBackupArchive)
+        #
+        findInBackupsAct = QAction('&Find document in backups', self)
+        findInBackupsAct.setStatusTip('Find the backups that contain a document and restore one of its versions on the tablet.')
+        findInBackupsAct.triggered.connect(self.findInBackups)
+        #
         sshMenu = menubar.addMenu('&SSH')
         sshMenu.addAction(backupDocsAct)
         sshMenu.addAction(restoreDocsAct)
+        sshMenu.addAction(restoreArchiveAct)
+        sshMenu.addSeparator()
+        sshMenu.addAction(verifyBackupAct)
+        sshMenu.addAction(verifyArchiveAct)
+        sshMenu.addSeparator()
+        sshMenu.addAction(findInBackupsAct)
 
         # About menu
         aboutAct = QAction(constants.AppName, self)
@@ -193,6 +247,8 @@ class RmExplorerWindow(QMainWindow):
         self.dirsListContextMenu = QMenu(self)
         downloadDirsAct = self.dirsListContextMenu.addAction('&Download')
         downloadDirsAct.triggered.connect(self.downloadDirsClicked)
+        backupDirsAct = self.dirsListContextMenu.addAction('&Backup')
+        backupDirsAct.triggered.connect(self.backupDirsClicked)
 
         # Context menu of the files QListWidget
         self.filesListContextMenu = QMenu(self)
@@ -200,15 +256,63 @@ class RmExplorerWindow(QMainWindow):
         downloadFilesAct.triggered.connect(self.downloadFilesClicked)
 
 
-    def goToDir(self, dirId, dirName):
+    def goToDir(self, dirId, dirName, refresh=False, allowStale=False):
+        """Shows the contents of a collection
 
-        try:
-            collections, docs = tools.listDir(dirId, self.settings)
-        except (urllib.error.URLError, socket.timeout) as e:
-            msg = getattr(e, 'reason', 'timeout')
-            QMessageBox.critical(self, constants.AppName,
-                                 'Could not go to directory "%s": URL error:\n%s' % (dirId, msg))
-            return
+        Listings are taken from memory or from the cache if they are younger
+        than the TreeCacheMaxAge setting, or whatever their age if
+        `allowStale` is set or if moving up to the parent collection.
+        `refresh` forces a request to the tablet.  Requests are made in the
+        background by listDirWorker and the lists are disabled until the
+        answer arrives.
+        """
+
+        movingUp = len(self.curDirParents) > 0 and self.curDirParents[-1] == dirId
+        if refresh:
+            maxAge = 0
+        elif allowStale or movingUp:
+            maxAge = None
+        else:
+            maxAge = self.settings.value('TreeCacheMaxAge', type=int)
+
+        if maxAge != 0:
+            if dirId in self.listings:
+                fetched, data = self.listings[dirId]
+                if maxAge is None or time.time() - fetched <= maxAge:
+                    self.setLoading(None)
+                    self.showDir(dirId, dirName, data)
+                    return
+            if allowStale:
+                data = self.treeCache.get(dirId, self.settings)
+                if data is not None:
+                    self.setLoading(None)
+                    self.showDir(dirId, dirName, data)
+                    # Show the last known contents while the tablet is asked
+                    # for the current ones.
+                    self.listDirRequested.emit(dirId, 0)
+                    return
+
+        self.setLoading((dirId, dirName))
+        self.listDirRequested.emit(dirId, maxAge)
+
+
+    def setLoading(self, pendingDir):
+        """Sets the collection being listed, or None when done loading"""
+
+        self.pendingDir = pendingDir
+        loading = pendingDir is not None
+        self.dirsList.setEnabled(not loading)
+        self.filesList.setEnabled(not loading)
+        if loading:
+            self.statusBar().showMessage('Loading...')
+        else:
+            self.statusBar().clearMessage()
+
+
+    def showDir(self, dirId, dirName, data):
+        """Updates the window with the listing of a collection"""
+
+        collections, docs = tools.parseDir(data)
 
         if dirId != self.curDir:
             # We are either moving up or down one level
@@ -240,15 +344,25 @@ class RmExplorerWindow(QMainWindow):
             self.dirIds = []
             self.dirNames = []
         self.fileIds = []
+        self.fileStamps = []
 
+        stamps = {elem['ID']: tools.docStamp(elem) for elem in data}
         for id_, name in collections:
             self.dirIds.append(id_)
             self.dirNames.append(name)
             self.dirsList.addItem(name)
         for id_, name in docs:
             self.fileIds.append(id_)
+            self.fileStamps.append(stamps[id_])
             self.filesList.addItem(name)
 
+        # Speculatively list the child collections so that going one level
+        # down is served from memory.
+        if self.settings.value('PrefetchCollections', type=bool):
+            dirIds = [id_ for id_, _ in collections if id_ not in self.listings]
+            if dirIds:
+                self.prefetchRequested.emit(dirIds[:constants.PrefetchMaxCollections])
+
 
     def downloadFile(self, basePath, fileDesc, mode):
 
@@ -272,34 +386,10 @@ class RmExplorerWindow(QMainWindow):
 
     def downloadDirs(self, dirs):
 
-        def listFiles(ext, baseFolderId, baseFolderPath, filesList):
-            url = self.settings.value('listFolderURL', type=str) % baseFolderId
-            try:
-                res = urllib.request.urlopen(url)
-                data = res.read().decode(constants.HttpJsonEncoding)
-            except (urllib.error.URLError, socket.timeout) as e:
-                warningBox = QMessageBox(self)
-                msg = getattr(e, 'reason', 'timeout')
-                warningBox.setText('URL error: %s. Aborted.' % msg)
-                warningBox.setIcon(QMessageBox.Warning)
-                warningBox.exec()
-                self.statusBar().showMessage('Download error.',
-                                             constants.StatusBarMsgDisplayDuration)
-                return
-            data = json.loads(data)
-            for elem in data:
-                if elem['Type'] == 'DocumentType':
-                    path = '%s.%s' % (os.path.join(baseFolderPath, elem['VissibleName']), ext) # yes, "Vissible"
-                    filesList.append((elem['ID'], path))
-                elif elem['Type'] == 'CollectionType':
-                    listFiles(ext, elem['ID'],
-                              os.path.join(baseFolderPath, elem['VissibleName']),
-                              filesList)
-
-        dialog = SaveOptsDialog(self.settings, self)
+        dialog = SaveOptsDialog(self.settings, self, showMirrorOpt=True)
         if dialog.exec() == QDialog.Accepted:
             mode = dialog.getSaveMode()
-            ext = mode
+            mirror = dialog.getMirrorMode()
             # Ask for destination folder
             folder = QFileDialog.getExistingDirectory(self,
                                                       'Save directory',
@@ -308,25 +398,28 @@ class RmExplorerWindow(QMainWindow):
                                                       | QFileDialog.DontResolveSymlinks)
             if folder:
                 self.settings.setValue('lastDir', folder)
-                # Construct files list
-                dlList = []
-                for dir_id, dir_name in dirs:
-                    listFiles(ext, dir_id, dir_name, dlList)
 
+                # The number of files is not known until the worker has
+                # crawled all the collections.
                 self.progressWindow = ProgressWindow(self)
                 self.progressWindow.setWindowTitle("Downloading...")
-                self.progressWindow.nSteps = len(dlList)
+                self.progressWindow.nSteps = 0
                 self.progressWindow.open()
 
                 self.settings.sync()
                 self.currentWarning = ''
                 self.downloadFilesWorker = DownloadFilesWorker(folder,
-                                                               dlList,
-                                                               mode)
+                                                               (),
+                                                               mode,
+                                                               mirror,
+                                                               dirs)
                 self.taskThread = QThread()
                 self.downloadFilesWorker.moveToThread(self.taskThread)
                 self.taskThread.started.connect(self.downloadFilesWorker.start)
+                self.downloadFilesWorker.notifyNSteps.connect(self.progressWindow.updateNSteps)
                 self.downloadFilesWorker.notifyProgress.connect(self.progressWindow.updateStep)
+                self.downloadFilesWorker.notifyFileBytes.connect(self.progressWindow.updateFileProgress)
+                self.downloadFilesWorker.notifyFileDone.connect(self.progressWindow.fileDone)
                 self.downloadFilesWorker.finished.connect(self.onDownloadFilesFinished)
                 self.downloadFilesWorker.warning.connect(self.warningRaised)
                 self.taskThread.start()
@@ -350,8 +443,8 @@ class RmExplorerWindow(QMainWindow):
             if folder:
                 self.settings.setValue('lastDir', folder)
                 # Construct files list
-                dlList = tuple((id_, os.path.join(folder, '%s.%s' % (name, ext)))
-                               for id_, name in files)
+                dlList = tuple((id_, os.path.join(folder, '%s.%s' % (name, ext)), stamp)
+                               for id_, name, stamp in files)
 
                 self.progressWindow = ProgressWindow(self)
                 self.progressWindow.setWindowTitle("Downloading...")
@@ -366,7 +459,10 @@ class RmExplorerWindow(QMainWindow):
                 self.taskThread = QThread()
                 self.downloadFilesWorker.moveToThread(self.taskThread)
                 self.taskThread.started.connect(self.downloadFilesWorker.start)
+                self.downloadFilesWorker.notifyNSteps.connect(self.progressWindow.updateNSteps)
                 self.downloadFilesWorker.notifyProgress.connect(self.progressWindow.updateStep)
+                self.downloadFilesWorker.notifyFileBytes.connect(self.progressWindow.updateFileProgress)
+                self.downloadFilesWorker.notifyFileDone.connect(self.progressWindow.fileDone)
                 self.downloadFilesWorker.finished.connect(self.onDownloadFilesFinished)
                 self.downloadFilesWorker.warning.connect(self.warningRaised)
                 self.taskThread.start()
@@ -377,6 +473,12 @@ class RmExplorerWindow(QMainWindow):
 
     def backupDocs(self):
 
+        self._backupDocs(collectionIds=None)
+
+
+    def _backupDocs(self, collectionIds):
+        """Backs up the documents, or only collections `collectionIds` and their content"""
+
         # Destination folder
         defaultDir = (self.settings.value('lastSSHBackupDir', type=str)
                       or self.settings.value('lastDir', type=str))
@@ -403,42 +505,44 @@ class RmExplorerWindow(QMainWindow):
 
         self.settings.sync()
         self.currentWarning = ''
-        self.backupDocsWorker = BackupDocsWorker(folder, self.settings._masterKey)
+        self.backupDocsWorker = BackupDocsWorker(folder, self.settings._masterKey,
+                                                 collectionIds)
 
         self.taskThread = QThread()
         self.backupDocsWorker.moveToThread(self.taskThread)
         self.taskThread.started.connect(self.backupDocsWorker.start)
         self.backupDocsWorker.notifyNSteps.connect(self.progressWindow.updateNSteps)
         self.backupDocsWorker.notifyProgress.connect(self.progressWindow.updateStep)
+        self.backupDocsWorker.notifyFileBytes.connect(self.progressWindow.updateFileProgress)
+        self.backupDocsWorker.notifyFileDone.connect(self.progressWindow.fileDone)
         self.backupDocsWorker.finished.connect(self.onBackupDocsFinished)
         self.backupDocsWorker.warning.connect(self.warningRaised)
         self.taskThread.start()
 
 
-    def restoreDocs(self):
+    def _selectBackup(self, fromArchive):
+        """Asks the user for a backup folder or archive and checks that it looks like a backup
 
-        # Confirm user has a backup folder
-        tabletDir = self.settings.value('TabletDocumentsDir')
-        msg = "To restore a backup, you need a previous copy on your computer of the tablet's \"%s\" folder. Ensure the backup you select was made with a tablet having the same software version as the device on which you want to restore the files.\n\n" % tabletDir
-        msg += "Do you have such a backup and want to proceed to the restoration?"
-        reply = QMessageBox.question(self, constants.AppName, msg)
-        if reply == QMessageBox.No:
-            self.statusBar().showMessage('Cancelled.',
-                                         constants.StatusBarMsgDisplayDuration)
-            return
+        Returns the path to the backup, or None if cancelled.
+        """
 
-        # Source folder
         defaultDir = (self.settings.value('lastSSHBackupDir', type=str)
                       or self.settings.value('lastDir', type=str))
-        folder = QFileDialog.getExistingDirectory(self,
-                                                  'Backup directory',
-                                                  defaultDir,
-                                                  QFileDialog.ShowDirsOnly
-                                                  | QFileDialog.DontResolveSymlinks)
+        if fromArchive:
+            folder, _ = QFileDialog.getOpenFileName(self,
+                                                    'Backup archive',
+                                                    defaultDir,
+                                                    'Backup archives (*.tar.gz *.tgz *.tar.xz *.zip)')
+        else:
+            folder = QFileDialog.getExistingDirectory(self,
+                                                      'Backup directory',
+                                                      defaultDir,
+                                                      QFileDialog.ShowDirsOnly
+                                                      | QFileDialog.DontResolveSymlinks)
         if not folder:
             self.statusBar().showMessage('Cancelled.',
                                          constants.StatusBarMsgDisplayDuration)
-            return
+            return None
         # Better here to set default location one level above to avoid saving
         # later a backup inside another backup:
         self.settings.setValue('lastSSHBackupDir', os.path.split(folder)[0])
@@ -449,6 +553,36 @@ class RmExplorerWindow(QMainWindow):
             QMessageBox.warning(self, constants.AppName, '%s\nAborting.' % msg)
             self.statusBar().showMessage('Cancelled.',
                                          constants.StatusBarMsgDisplayDuration)
+            return None
+
+        return folder
+
+
+    def restoreDocs(self):
+
+        self._restoreDocs(fromArchive=False)
+
+
+    def restoreDocsFromArchive(self):
+
+        self._restoreDocs(fromArchive=True)
+
+
+    def _restoreDocs(self, fromArchive):
+
+        # Confirm user has a backup folder
+        tabletDir = self.settings.value('TabletDocumentsDir')
+        msg = "To restore a backup, you need a previous copy on your computer of the tablet's \"%s\" folder. Ensure the backup you select was made with a tablet having the same software version as the device on which you want to restore the files.\n\n" % tabletDir
+        msg += "Do you have such a backup and want to proceed to the restoration?"
+        reply = QMessageBox.question(self, constants.AppName, msg)
+        if reply == QMessageBox.No:
+            self.statusBar().showMessage('Cancelled.',
+                                         constants.StatusBarMsgDisplayDuration)
+            return
+
+        # Source folder
+        folder = self._selectBackup(fromArchive)
+        if folder is None:
             return
 
         if not self.settings.unlockMasterKeyInteractive(self):
@@ -458,8 +592,16 @@ class RmExplorerWindow(QMainWindow):
 
         # Last chance to cancel!
         msg = "%s is now ready to restore the documents. Please check that the tablet is turned on, unlocked and that Wifi is enabled. Make sure no file is open and do not use the tablet during the upload.\n\n" % constants.AppName
-        msg += "When the upload finishes, please reboot the tablet.\n\n"
-        msg += "To restore documents, contents on the tablet will first be deleted. By continuing, you acknowledge that you take the sole responsibility for any possible data loss or damage caused to the tablet that may result from using %s.\n\n" % constants.AppName
+        staged = self.settings.value('StagedRestore', type=bool)
+        if staged:
+            msg += "Documents are uploaded to a staging folder on the tablet. When the upload finishes, it replaces the documents folder and the tablet's interface is restarted.\n\n"
+        else:
+            msg += "When the upload finishes, please reboot the tablet.\n\n"
+        if self.settings.value('DifferentialRestore', type=bool):
+            msg += "To restore documents, files on the tablet that are not in the backup will be deleted and files that differ will be overwritten. "
+        else:
+            msg += "To restore documents, contents on the tablet will first be deleted. "
+        msg += "By continuing, you acknowledge that you take the sole responsibility for any possible data loss or damage caused to the tablet that may result from using %s.\n\n" % constants.AppName
         msg += "Do you want to continue?"
         reply = QMessageBox.question(self, constants.AppName, msg)
         if reply == QMessageBox.No:
@@ -467,13 +609,23 @@ class RmExplorerWindow(QMainWindow):
                                          constants.StatusBarMsgDisplayDuration)
             return
 
+        self._startRestore(folder, needsReboot=not staged)
+
+
+    def _startRestore(self, folder, docIds=None, needsReboot=False):
+        """Starts restoring a backup, or only some documents of it if `docIds` is given
+
+        `needsReboot` tells if the user must reboot the tablet afterwards.
+        """
+
         self.progressWindow = ProgressWindow(self)
         self.progressWindow.setWindowTitle("Restoring backup...")
         self.progressWindow.open()
 
         self.settings.sync()
         self.hasRaised = False
-        self.restoreDocsWorker = RestoreDocsWorker(folder, self.settings._masterKey)
+        self.restoreNeedsReboot = needsReboot
+        self.restoreDocsWorker = RestoreDocsWorker(folder, self.settings._masterKey, docIds)
 
         self.taskThread = QThread()
         self.restoreDocsWorker.moveToThread(self.taskThread)
@@ -485,13 +637,133 @@ class RmExplorerWindow(QMainWindow):
         self.taskThread.start()
 
 
+    def verifyBackup(self):
+
+        self._verifyBackup(fromArchive=False)
+
+
+    def verifyBackupArchive(self):
+
+        self._verifyBackup(fromArchive=True)
+
+
+    def _verifyBackup(self, fromArchive):
+
+        folder = self._selectBackup(fromArchive)
+        if folder is None:
+            return
+
+        # The SSH password is needed to compare the backup with the tablet
+        if not self.settings.unlockMasterKeyInteractive(self):
+            self.statusBar().showMessage('Cancelled.',
+                                         constants.StatusBarMsgDisplayDuration)
+            return
+
+        self.progressWindow = ProgressWindow(self)
+        self.progressWindow.setWindowTitle("Verifying backup...")
+        self.progressWindow.open()
+
+        self.settings.sync()
+        self.hasRaised = False
+        self.verifyBackupWorker = VerifyBackupWorker(folder, self.settings._masterKey)
+
+        self.taskThread = QThread()
+        self.verifyBackupWorker.moveToThread(self.taskThread)
+        self.taskThread.started.connect(self.verifyBackupWorker.start)
+        self.verifyBackupWorker.notifyNSteps.connect(self.progressWindow.updateNSteps)
+        self.verifyBackupWorker.notifyProgress.connect(self.progressWindow.updateStep)
+        self.verifyBackupWorker.report.connect(self.onVerifyBackupReport)
+        self.verifyBackupWorker.finished.connect(self.onVerifyBackupFinished)
+        self.verifyBackupWorker.error.connect(self.errorRaised)
+        self.taskThread.start()
+
+
+    def findInBackups(self):
+
+        defaultDir = (self.settings.value('lastSSHBackupDir', type=str)
+                      or self.settings.value('lastDir', type=str))
+        folder = QFileDialog.getExistingDirectory(self,
+                                                  'Backups directory',
+                                                  defaultDir,
+                                                  QFileDialog.ShowDirsOnly
+                                                  | QFileDialog.DontResolveSymlinks)
+        if not folder:
+            self.statusBar().showMessage('Cancelled.',
+                                         constants.StatusBarMsgDisplayDuration)
+            return
+
+        self.settings.setValue('lastSSHBackupDir', folder)
+        self.catalogFolder = os.path.normpath(folder)
+
+        self.progressWindow = ProgressWindow(self)
+        self.progressWindow.setWindowTitle("Indexing backups...")
+        self.progressWindow.open()
+
+        self.currentWarning = ''
+        self.indexBackupsWorker = IndexBackupsWorker(self.catalog, self.catalogFolder)
+
+        self.taskThread = QThread()
+        self.indexBackupsWorker.moveToThread(self.taskThread)
+        self.taskThread.started.connect(self.indexBackupsWorker.start)
+        self.indexBackupsWorker.notifyNSteps.connect(self.progressWindow.updateNSteps)
+        self.indexBackupsWorker.notifyProgress.connect(self.progressWindow.updateStep)
+        self.indexBackupsWorker.finished.connect(self.onIndexBackupsFinished)
+        self.indexBackupsWorker.warning.connect(self.warningRaised)
+        self.taskThread.start()
+
+
+    def restoreDocument(self, document):
+        """Restores one version of a document found in the snapshot catalog"""
+
+        if not self.settings.unlockMasterKeyInteractive(self):
+            self.statusBar().showMessage('Cancelled.',
+                                         constants.StatusBarMsgDisplayDuration)
+            return
+
+        msg = "%s is now ready to restore \"%s\" from backup %s. Please check that the tablet is turned on, unlocked and that Wifi is enabled.\n\n" % (constants.AppName, document.name, os.path.basename(document.snapshot))
+        msg += "The files of this document on the tablet will be replaced and the tablet's interface will be restarted. Other documents are left untouched. "
+        msg += "By continuing, you acknowledge that you take the sole responsibility for any possible data loss or damage caused to the tablet that may result from using %s.\n\n" % constants.AppName
+        msg += "Do you want to continue?"
+        reply = QMessageBox.question(self, constants.AppName, msg)
+        if reply == QMessageBox.No:
+            self.statusBar().showMessage('Cancelled.',
+                                         constants.StatusBarMsgDisplayDuration)
+            return
+
+        self._startRestore(document.snapshot, docIds=[document.uuid])
+
+
     #########
     # Slots #
     #########
 
     def refreshLists(self):
 
-        self.goToDir(self.curDir, self.curDirName)
+        self.goToDir(self.curDir, self.curDirName, refresh=True)
+
+
+    def onDirListed(self, dirId, data, prefetched):
+
+        self.listings[dirId] = (time.time(), data)
+        if self.pendingDir is not None:
+            if self.pendingDir[0] == dirId:
+                dirName = self.pendingDir[1]
+                self.setLoading(None)
+                self.showDir(dirId, dirName, data)
+        elif dirId == self.curDir and not prefetched:
+            # Answer to a refresh of the displayed collection
+            self.showDir(self.curDir, self.curDirName, data)
+
+
+    def onListDirFailed(self, dirId, msg):
+
+        if self.pendingDir is not None and self.pendingDir[0] == dirId:
+            self.setLoading(None)
+            QMessageBox.critical(self, constants.AppName,
+                                 'Could not go to directory "%s": URL error:\n%s' % (dirId, msg))
+        elif self.pendingDir is None and dirId == self.curDir:
+            self.statusBar().showMessage('Could not refresh folder contents: %s' % msg,
+                                         constants.StatusBarMsgDisplayDuration)
 
 
     def dirsListItemDoubleClicked(self, item):
@@ -544,7 +816,8 @@ class RmExplorerWindow(QMainWindow):
 
         items = self.filesList.selectionModel().selectedIndexes()
         files = tuple((self.fileIds[i.row()],
-                       self.filesList.item(i.row()).text()) for i in items)
+                       self.filesList.item(i.row()).text(),
+                       self.fileStamps[i.row()]) for i in items)
         self.downloadFiles(files)
 
 
@@ -555,6 +828,16 @@ class RmExplorerWindow(QMainWindow):
         self.downloadDirs(dirs)
 
 
+    def backupDirsClicked(self):
+
+        items = self.dirsList.selectionModel().selectedIndexes()
+        collectionIds = [self.dirIds[i.row()] for i in items]
+        # The root collection contains everything
+        if '' in collectionIds:
+            collectionIds = None
+        self._backupDocs(collectionIds)
+
+
     def downloadAll(self):
 
         self.downloadDirs((('', ''),))
@@ -611,7 +894,10 @@ class RmExplorerWindow(QMainWindow):
         self.progressWindow.hide()
 
         self.taskThread.started.disconnect(self.downloadFilesWorker.start)
+        self.downloadFilesWorker.notifyNSteps.disconnect(self.progressWindow.updateNSteps)
         self.downloadFilesWorker.notifyProgress.disconnect(self.progressWindow.updateStep)
+        self.downloadFilesWorker.notifyFileBytes.disconnect(self.progressWindow.updateFileProgress)
+        self.downloadFilesWorker.notifyFileDone.disconnect(self.progressWindow.fileDone)
         self.downloadFilesWorker.warning.disconnect(self.warningRaised)
         self.downloadFilesWorker.finished.disconnect(self.onDownloadFilesFinished)
 
@@ -653,6 +939,9 @@ class RmExplorerWindow(QMainWindow):
         if self.currentWarning:
             QMessageBox.warning(self, constants.AppName,
                                 'Errors were encountered:\n%s' % self.currentWarning)
+        # The uploaded documents may appear in any collection
+        self.treeCache.invalidate()
+        self.listings.clear()
         self.refreshLists()
         self.statusBar().showMessage('Finished uploading files.',
                                      constants.StatusBarMsgDisplayDuration)
@@ -676,6 +965,8 @@ class RmExplorerWindow(QMainWindow):
         self.backupDocsWorker.finished.disconnect(self.onBackupDocsFinished)
         self.backupDocsWorker.notifyNSteps.disconnect(self.progressWindow.updateNSteps)
         self.backupDocsWorker.notifyProgress.disconnect(self.progressWindow.updateStep)
+        self.backupDocsWorker.notifyFileBytes.disconnect(self.progressWindow.updateFileProgress)
+        self.backupDocsWorker.notifyFileDone.disconnect(self.progressWindow.fileDone)
 
         self.progressWindow.deleteLater()
 
@@ -712,13 +1003,82 @@ class RmExplorerWindow(QMainWindow):
         self.taskThread.wait()
 
         if not self.hasRaised:
-            QMessageBox.information(self, constants.AppName,
-                                    'Backup was restored successfully! Please reboot the tablet now.')
+            if self.restoreNeedsReboot:
+                QMessageBox.information(self, constants.AppName,
+                                        'Backup was restored successfully! Please reboot the tablet now.')
+            else:
+                QMessageBox.information(self, constants.AppName,
+                                        'Backup was restored successfully!')
 
             self.statusBar().showMessage('Finished restoring backup.',
                                          constants.StatusBarMsgDisplayDuration)
 
 
+    def onVerifyBackupReport(self, msg):
+
+        QMessageBox.information(self, constants.AppName, msg)
+
+
+    def onVerifyBackupFinished(self):
+
+        self.progressWindow.hide()
+
+        self.taskThread.started.disconnect(self.verifyBackupWorker.start)
+        self.verifyBackupWorker.error.disconnect(self.errorRaised)
+        self.verifyBackupWorker.report.disconnect(self.onVerifyBackupReport)
+        self.verifyBackupWorker.finished.disconnect(self.onVerifyBackupFinished)
+        self.verifyBackupWorker.notifyNSteps.disconnect(self.progressWindow.updateNSteps)
+        self.verifyBackupWorker.notifyProgress.disconnect(self.progressWindow.updateStep)
+
+        self.progressWindow.deleteLater()
+
+        self.taskThread.quit()
+        self.verifyBackupWorker.deleteLater()
+        self.taskThread.deleteLater()
+        self.taskThread.wait()
+
+        if not self.hasRaised:
+            self.statusBar().showMessage('Finished verifying backup.',
+                                         constants.StatusBarMsgDisplayDuration)
+
+
+    def onIndexBackupsFinished(self):
+
+        self.progressWindow.hide()
+
+        self.taskThread.started.disconnect(self.indexBackupsWorker.start)
+        self.indexBackupsWorker.warning.disconnect(self.warningRaised)
+        self.indexBackupsWorker.finished.disconnect(self.onIndexBackupsFinished)
+        self.indexBackupsWorker.notifyNSteps.disconnect(self.progressWindow.updateNSteps)
+        self.indexBackupsWorker.notifyProgress.disconnect(self.progressWindow.updateStep)
+
+        self.progressWindow.deleteLater()
+
+        self.taskThread.quit()
+        self.indexBackupsWorker.deleteLater()
+        self.taskThread.deleteLater()
+        self.taskThread.wait()
+
+        if self.currentWarning:
+            QMessageBox.warning(self, constants.AppName,
+                                'Some backups could not be indexed:\n%s' % self.currentWarning)
+
+        dialog = CatalogDialog(self.catalog, self.catalogFolder, self)
+        if dialog.exec() == QDialog.Accepted:
+            self.restoreDocument(dialog.selectedDocument())
+        else:
+            self.statusBar().showMessage('Cancelled.',
+                                         constants.StatusBarMsgDisplayDuration)
+
+
+    def closeEvent(self, event):
+
+        self.listDirWorker.stop()
+        self.listThread.quit()
+        self.listThread.wait()
+        super().closeEvent(event)
+
+
     def about(self):
 
         msg = """<b>pyrmexplorer: Explorer for Remarkable tablets</b><br/><br/>
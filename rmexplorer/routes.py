@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+"""Choice of the fastest way to reach the tablet, over USB or Wifi
+
+The tablet can be reached at the address of the HTTP URLs (the USB network
+by default), at the SSH hostname, and at the IP address the hostname last
+resolved to. Each of them is probed, and SSH and HTTP requests are sent to
+the fastest one. Results are cached in the settings, so that slow hostname
+lookups are only done when probing.
+"""
+
+
+import time
+import socket
+import threading
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import rmexplorer.constants as constants
+
+
+# `address` is the IP address `host` resolved to. `sshLatency` is the time in
+# seconds to resolve the host and connect to its SSH port, and
+# `httpThroughput` the speed in bytes per second of a listing request. They
+# are None when the host cannot be reached that way.
+Probe = collections.namedtuple('Probe', ['host', 'address', 'sshLatency', 'httpThroughput'])
+
+
+def _urlHost(settings):
+
+    return urllib.parse.urlsplit(settings.value('listFolderURL', type=str)).hostname or ''
+
+
+def candidateHosts(settings):
+    """Returns the hosts through which the tablet may be reached"""
+
+    hosts = []
+    for host in (_urlHost(settings),
+                 settings.value('TabletResolvedIP', type=str),
+                 settings.value('TabletHostname', type=str)):
+        if host and host not in hosts:
+            hosts.append(host)
+
+    return hosts
+
+
+def _withHost(url, host):
+    """Returns `url` with its host replaced by `host`"""
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.hostname is None:
+        return url
+    netloc = host if ':' not in host else '[%s]' % host
+    if parts.port is not None:
+        netloc += ':%d' % parts.port
+
+    return urllib.parse.urlunsplit(parts._replace(netloc=netloc))
+
+
+def probeHost(host, listUrl):
+    """Measures how fast the tablet is reached through `host`"""
+
+    start = time.monotonic()
+    try:
+        address = socket.getaddrinfo(host, constants.SSHPort, type=socket.SOCK_STREAM)[0][4][0]
+    except OSError:
+        return Probe(host, None, None, None)
+
+    sshLatency = None
+    try:
+        with socket.create_connection((address, constants.SSHPort),
+                                      timeout=constants.RouteProbeTimeout):
+            sshLatency = time.monotonic() - start
+    except OSError:
+        pass
+
+    httpThroughput = None
+    try:
+        httpStart = time.monotonic()
+        with urllib.request.urlopen(_withHost(listUrl % '', address),
+                                    timeout=constants.RouteProbeTimeout) as res:
+            size = len(res.read())
+        httpThroughput = size / max(time.monotonic() - httpStart, 1e-6)
+    except (OSError, ValueError):
+        pass
+
+    return Probe(host, address, sshLatency, httpThroughput)
+
+
+def probe(settings):
+    """Probes all the candidate hosts at once and returns their Probe"""
+
+    listUrl = settings.value('listFolderURL', type=str)
+    probes = {}
+    def run(host):
+        probes[host] = probeHost(host, listUrl)
+
+    threads = [threading.Thread(target=run, args=(host,), daemon=True)
+               for host in candidateHosts(settings)]
+    for thread in threads:
+        thread.start()
+    # A host still being resolved or connected to past the deadline is
+    # ignored.
+    deadline = time.monotonic() + 3 * constants.RouteProbeTimeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+    return [probes[host] for host in candidateHosts(settings) if host in probes]
+
+
+_lock = threading.Lock()
+
+
+def _update(settings):
+    """Probes the hosts if the cached routes are too old"""
+
+    with _lock:
+        age = time.time() - settings.value('RouteProbeTime', type=float)
+        if 0 <= age < constants.RouteCacheMaxAge:
+            return
+        probes = probe(settings)
+        hostname = settings.value('TabletHostname', type=str)
+        for p in probes:
+            if p.host == hostname and p.address is not None:
+                settings.setValue('TabletResolvedIP', p.address)
+        sshProbes = [p for p in probes if p.sshLatency is not None]
+        httpProbes = [p for p in probes if p.httpThroughput is not None]
+        settings.setValue('RouteSSHHost',
+                          min(sshProbes, key=lambda p: p.sshLatency).address if sshProbes else '')
+        settings.setValue('RouteHTTPHost',
+                          max(httpProbes, key=lambda p: p.httpThroughput).address if httpProbes else '')
+        settings.setValue('RouteProbeTime', time.time())
+
+
+def isRouteFailure(error):
+    """Tells if an HTTP error means that the tablet could not be reached
+
+    Errors sent by the tablet and timeouts of a request to a reachable
+    tablet do not call the route into question.
+    """
+
+    if isinstance(error, urllib.error.HTTPError):
+        return False
+    if isinstance(error, urllib.error.URLError):
+        return isinstance(error.reason, OSError)
+
+    return isinstance(error, ConnectionError)
+
+
+def invalidate(settings):
+    """Forgets the cached routes, after a connection through them failed"""
+
+    settings.setValue('RouteProbeTime', 0.0)
+
+
+def sshHost(settings):
+    """Returns the host to connect to with SSH"""
+
+    if settings.value('AutoRoute', type=bool):
+        _update(settings)
+        host = settings.value('RouteSSHHost', type=str)
+        if host:
+            return host
+
+    return settings.value('TabletHostname', type=str)
+
+
+def url(settings, key):
+    """Returns the URL of setting `key`, sent through the fastest host"""
+
+    value = settings.value(key, type=str)
+    if settings.value('AutoRoute', type=bool):
+        _update(settings)
+        host = settings.value('RouteHTTPHost', type=str)
+        if host:
+            return _withHost(value, host)
+
+    return value
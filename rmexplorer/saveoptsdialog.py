@@ -25,30 +25,35 @@
 """Qt dialog that presents saving options to the user"""
 
 
-from PyQt5.QtWidgets import QVBoxLayout, QRadioButton
+from PyQt5.QtWidgets import QVBoxLayout, QRadioButton, QCheckBox
 
 from rmexplorer.okcanceldialog import OKCancelDialog
 
 
 class SaveOptsDialog(OKCancelDialog):
 
-    def __init__(self, settings, parent=None):
+    def __init__(self, settings, parent=None, showMirrorOpt=False):
 
         super().__init__(parent=parent)
 
         self.settings = settings
         self.pdfRB = QRadioButton('Save as PDF', self)
         self.pngRB = QRadioButton('Save as stack of PNG', self)
+        self.mirrorCB = QCheckBox('Only download new or changed documents', self)
 
         lastMode = self.settings.value('lastSaveMode', type=str)
         if lastMode == 'pdf':
             self.pdfRB.setChecked(True)
         else:
             self.pngRB.setChecked(True)
+        self.mirrorCB.setChecked(self.settings.value('lastMirrorMode', type=bool))
+        self.mirrorCB.setVisible(showMirrorOpt)
+        self._showMirrorOpt = showMirrorOpt
 
         mainLayout = QVBoxLayout()
         mainLayout.addWidget(self.pdfRB)
         mainLayout.addWidget(self.pngRB)
+        mainLayout.addWidget(self.mirrorCB)
 
         self.setLayout(mainLayout)
 
@@ -61,8 +66,15 @@ class SaveOptsDialog(OKCancelDialog):
             self.settings.setValue('lastSaveMode', 'pdf')
         else:
             self.settings.setValue('lastSaveMode', 'png')
+        if self._showMirrorOpt:
+            self.settings.setValue('lastMirrorMode', self.mirrorCB.isChecked())
 
 
     def getSaveMode(self):
 
         return 'pdf' if self.pdfRB.isChecked() else 'png'
+
+
+    def getMirrorMode(self):
+
+        return self._showMirrorOpt and self.mirrorCB.isChecked()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+"""Rules choosing which files of the tablet are backed up
+
+Files of the tablet's documents folder belong to the document or collection
+whose UUID starts their name, as in "<uuid>.metadata" or "<uuid>/<page>.rm".
+"""
+
+
+import fnmatch
+import collections
+
+
+# Parent of the documents and collections in the trash
+TrashId = 'trash'
+
+
+def documentId(path):
+    """Returns the UUID of the document a path relative to the documents folder belongs to"""
+
+    return path.split('/')[0].split('.')[0]
+
+
+def parsePatterns(text):
+    """Returns the list of patterns of a setting separated by semicolons"""
+
+    return [pattern.strip() for pattern in text.split(';') if pattern.strip()]
+
+
+def isExcluded(path, patterns):
+    """Tells if a file or folder matches one of the exclude patterns
+
+    Patterns are matched against each component of `path`, so that the
+    content of an excluded folder is excluded too.
+    """
+
+    return any(fnmatch.fnmatchcase(name, pattern)
+               for name in path.split('/') for pattern in patterns)
+
+
+def _descendants(children, ids):
+
+    found = set()
+    pending = list(ids)
+    while pending:
+        id_ = pending.pop()
+        if id_ not in found:
+            found.add(id_)
+            pending += children.get(id_, [])
+
+    return found
+
+
+def _children(metadata):
+    """Returns the UUIDs of the documents and collections in each collection"""
+
+    children = collections.defaultdict(list)
+    for id_, data in metadata.items():
+        children[data.get('parent', '')].append(id_)
+
+    return children
+
+
+def selectDocuments(metadata, collectionIds):
+    """Returns the UUIDs of collections `collectionIds` and of their content
+
+    `metadata` maps UUIDs to the content of the .metadata files. The parent
+    collections are selected too, so that the documents can be restored at
+    their place.
+    """
+
+    selected = _descendants(_children(metadata), collectionIds)
+    for id_ in collectionIds:
+        parent = metadata.get(id_, {}).get('parent', '')
+        while parent in metadata and parent not in selected:
+            selected.add(parent)
+            parent = metadata[parent].get('parent', '')
+
+    return selected & set(metadata)
+
+
+def trashedDocuments(metadata):
+    """Returns the UUIDs of the documents and collections in the trash"""
+
+    return _descendants(_children(metadata), [TrashId]) - {TrashId}
@@ -26,6 +26,7 @@
 
 
 import base64
+import threading
 import Cryptodome.Cipher.AES
 import Cryptodome.Random
 import Cryptodome.Protocol.KDF
@@ -249,6 +250,12 @@ class Settings():
         self._get_or_set('lastSSHBackupDir',
                          QStandardPaths.writableLocation(QStandardPaths.DocumentsLocation))
         self._get_or_set('lastSaveMode', 'pdf')
+        self._get_or_set('lastMirrorMode', False)
+        # Fastest routes to the tablet, see routes.py
+        self._get_or_set('TabletResolvedIP', '')
+        self._get_or_set('RouteSSHHost', '')
+        self._get_or_set('RouteHTTPHost', '')
+        self._get_or_set('RouteProbeTime', 0.0)
         self._get_or_set('KDF.Algorithm', '')
         self._get_or_set('KDF.Salt', '')
         self._get_or_set('KDF.Iterations', '')
@@ -261,9 +268,29 @@ class Settings():
         self._get_or_set('HTTPTimeout', 60)
         self._get_or_set('HTTPShortTimeout', 1.0)
         self._get_or_set('PNGResolution', 360)
+        self._get_or_set('PNGRenderer', 'auto')
+        self._get_or_set('DownloadConcurrency', 4)
+        self._get_or_set('RenderProcesses', 0)
+        self._get_or_set('ExportCacheMaxMB', 1024)
+        self._get_or_set('TreeCacheMaxAge', 300)
+        self._get_or_set('ListingConcurrency', 4)
+        self._get_or_set('PrefetchCollections', True)
         self._get_or_set('TabletHostname', '')
+        self._get_or_set('AutoRoute', True)
         self._get_or_set('SSHUsername', 'root')
         self._get_or_set('TabletDocumentsDir', '/home/root/.local/share/remarkable/xochitl')
+        self._get_or_set('SFTPChannels', 4)
+        self._get_or_set('IncrementalBackups', True)
+        self._get_or_set('BackupMethod', 'sftp')
+        self._get_or_set('TarCompression', False)
+        self._get_or_set('BackupFormat', 'folder')
+        self._get_or_set('BackupExcludePatterns', '*.thumbnails;*.cache')
+        self._get_or_set('BackupSkipTrash', False)
+        self._get_or_set('DifferentialRestore', True)
+        self._get_or_set('RestoreCompareHashes', False)
+        self._get_or_set('RestoreMethod', 'sftp')
+        self._get_or_set('StagedRestore', True)
+        self._get_or_set('DeltaTransfer', True)
 
         # Group containing all settings encrypted with the master key
         self.beginGroup('Encrypted')
@@ -281,3 +308,23 @@ class Settings():
             self._settings.setValue(key, defaultValue)
 
         return self._settings.value(key)
+
+
+class ThreadLocalSettings():
+    """Gives each thread its own Settings instance
+
+    QSettings objects are reentrant but not thread-safe, so workers that use
+    a pool of threads must not share a single Settings object between them.
+    """
+
+    def __init__(self, masterKey=None):
+
+        self._masterKey = masterKey
+        self._local = threading.local()
+
+
+    def get(self):
+
+        if not hasattr(self._local, 'settings'):
+            self._local.settings = Settings(self._masterKey)
+        return self._local.settings
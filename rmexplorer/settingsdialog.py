@@ -27,13 +27,17 @@
 
 from PyQt5.QtCore import QLocale
 from PyQt5.QtWidgets import (QLabel, QLineEdit, QPushButton, QGroupBox,
-                             QGridLayout, QVBoxLayout, QMessageBox, QDialog)
+                             QCheckBox, QComboBox, QGridLayout, QVBoxLayout,
+                             QMessageBox, QDialog)
 from PyQt5.QtGui import QValidator, QIntValidator, QDoubleValidator
 
 from rmexplorer.okcanceldialog import OKCancelDialog
 from rmexplorer.changepassphrasedialog import ChangePassphraseDialog
 from rmexplorer.editpassword import EditPassword
 import rmexplorer.constants as constants
+import rmexplorer.renderers as renderers
+import rmexplorer.sshpool as sshpool
+import rmexplorer.routes as routes
 
 
 class SettingsDialog(OKCancelDialog):
@@ -77,6 +81,40 @@ class SettingsDialog(OKCancelDialog):
         self.pngResolutionLE.setValidator(QIntValidator(constants.PngExportDpiMin,
                                                         constants.PngExportDpiMax,
                                                         self))
+        val = locale.toString(self.settings.value('DownloadConcurrency', type=int))
+        self.downloadConcurrencyLE = QLineEdit(val, self)
+        self.downloadConcurrencyLE.setValidator(QIntValidator(constants.DownloadConcurrencyMin,
+                                                              constants.DownloadConcurrencyMax,
+                                                              self))
+        val = locale.toString(self.settings.value('TreeCacheMaxAge', type=int))
+        self.treeCacheMaxAgeLE = QLineEdit(val, self)
+        self.treeCacheMaxAgeLE.setValidator(QIntValidator(constants.TreeCacheMaxAgeMin,
+                                                          constants.TreeCacheMaxAgeMax,
+                                                          self))
+        val = locale.toString(self.settings.value('ListingConcurrency', type=int))
+        self.listingConcurrencyLE = QLineEdit(val, self)
+        self.listingConcurrencyLE.setValidator(QIntValidator(constants.ListingConcurrencyMin,
+                                                             constants.ListingConcurrencyMax,
+                                                             self))
+        self.prefetchCollectionsCB = QCheckBox('Prefetch subfolders', self)
+        self.prefetchCollectionsCB.setChecked(self.settings.value('PrefetchCollections', type=bool))
+        val = locale.toString(self.settings.value('RenderProcesses', type=int))
+        self.renderProcessesLE = QLineEdit(val, self)
+        self.renderProcessesLE.setValidator(QIntValidator(constants.RenderProcessesMin,
+                                                          constants.RenderProcessesMax,
+                                                          self))
+        val = locale.toString(self.settings.value('ExportCacheMaxMB', type=int))
+        self.exportCacheMaxMBLE = QLineEdit(val, self)
+        self.exportCacheMaxMBLE.setValidator(QIntValidator(constants.ExportCacheMaxMBMin,
+                                                           constants.ExportCacheMaxMBMax,
+                                                           self))
+        self.pngRendererCB = QComboBox(self)
+        self.pngRendererCB.addItem('Automatic (fastest available)', 'auto')
+        for cls in renderers.Renderers:
+            desc = cls.description if cls.isAvailable() else '%s (not found)' % cls.description
+            self.pngRendererCB.addItem(desc, cls.name)
+        idx = self.pngRendererCB.findData(self.settings.value('PNGRenderer', type=str))
+        self.pngRendererCB.setCurrentIndex(max(idx, 0))
         miscLayout = QGridLayout()
         miscLayout.addWidget(QLabel('HTTP timeout (s):'), 0, 0)
         miscLayout.addWidget(self.httpTimeoutLE, 0, 1)
@@ -84,6 +122,19 @@ class SettingsDialog(OKCancelDialog):
         miscLayout.addWidget(self.httpShortTimeoutLE, 1, 1)
         miscLayout.addWidget(QLabel('PNG export resolution (dpi):'), 2, 0)
         miscLayout.addWidget(self.pngResolutionLE, 2, 1)
+        miscLayout.addWidget(QLabel('Parallel downloads:'), 3, 0)
+        miscLayout.addWidget(self.downloadConcurrencyLE, 3, 1)
+        miscLayout.addWidget(QLabel('Folder cache lifetime (s):'), 4, 0)
+        miscLayout.addWidget(self.treeCacheMaxAgeLE, 4, 1)
+        miscLayout.addWidget(QLabel('Parallel folder listings:'), 5, 0)
+        miscLayout.addWidget(self.listingConcurrencyLE, 5, 1)
+        miscLayout.addWidget(QLabel('PNG rendering processes (0: one per CPU):'), 6, 0)
+        miscLayout.addWidget(self.renderProcessesLE, 6, 1)
+        miscLayout.addWidget(QLabel('PNG renderer:'), 7, 0)
+        miscLayout.addWidget(self.pngRendererCB, 7, 1)
+        miscLayout.addWidget(QLabel('Export cache size (MB, 0: disabled):'), 8, 0)
+        miscLayout.addWidget(self.exportCacheMaxMBLE, 8, 1)
+        miscLayout.addWidget(self.prefetchCollectionsCB, 9, 0, 1, 2)
         miscGroupBox.setLayout(miscLayout)
 
         securityGroupBox = QGroupBox('Security', self)
@@ -103,6 +154,46 @@ class SettingsDialog(OKCancelDialog):
         self.sshUsernameLE = QLineEdit(self.settings.value('SSHUsername', type=str), self)
         self.changeSSHPasswordBtn = QPushButton("Set/change", self)
         self.changeSSHPasswordBtn.clicked.connect(self.changeSSHPassword)
+        val = locale.toString(self.settings.value('SFTPChannels', type=int))
+        self.sftpChannelsLE = QLineEdit(val, self)
+        self.sftpChannelsLE.setValidator(QIntValidator(constants.SFTPChannelsMin,
+                                                       constants.SFTPChannelsMax,
+                                                       self))
+        self.incrementalBackupsCB = QCheckBox('Incremental backups (reuse unchanged files of the previous backup folder)', self)
+        self.incrementalBackupsCB.setChecked(self.settings.value('IncrementalBackups', type=bool))
+        self.backupMethodCB = QComboBox(self)
+        self.backupMethodCB.addItem('SFTP (file by file)', 'sftp')
+        self.backupMethodCB.addItem('tar stream', 'tar')
+        idx = self.backupMethodCB.findData(self.settings.value('BackupMethod', type=str))
+        self.backupMethodCB.setCurrentIndex(max(idx, 0))
+        self.tarCompressionCB = QCheckBox('Compress tar streams', self)
+        self.tarCompressionCB.setChecked(self.settings.value('TarCompression', type=bool))
+        self.backupFormatCB = QComboBox(self)
+        self.backupFormatCB.addItem('Folder', 'folder')
+        self.backupFormatCB.addItem('tar.gz archive', 'tar.gz')
+        self.backupFormatCB.addItem('tar.xz archive', 'tar.xz')
+        self.backupFormatCB.addItem('zip archive', 'zip')
+        idx = self.backupFormatCB.findData(self.settings.value('BackupFormat', type=str))
+        self.backupFormatCB.setCurrentIndex(max(idx, 0))
+        self.backupExcludesLE = QLineEdit(self.settings.value('BackupExcludePatterns', type=str), self)
+        self.backupExcludesLE.setToolTip('Names of the files and folders not to back up, separated by semicolons, e.g. *.thumbnails;*.cache')
+        self.backupSkipTrashCB = QCheckBox('Do not back up the trash', self)
+        self.backupSkipTrashCB.setChecked(self.settings.value('BackupSkipTrash', type=bool))
+        self.differentialRestoreCB = QCheckBox('Only upload files that differ when restoring', self)
+        self.differentialRestoreCB.setChecked(self.settings.value('DifferentialRestore', type=bool))
+        self.restoreCompareHashesCB = QCheckBox('Compare file contents when restoring (slower)', self)
+        self.restoreCompareHashesCB.setChecked(self.settings.value('RestoreCompareHashes', type=bool))
+        self.restoreMethodCB = QComboBox(self)
+        self.restoreMethodCB.addItem('SFTP (file by file)', 'sftp')
+        self.restoreMethodCB.addItem('tar stream', 'tar')
+        idx = self.restoreMethodCB.findData(self.settings.value('RestoreMethod', type=str))
+        self.restoreMethodCB.setCurrentIndex(max(idx, 0))
+        self.stagedRestoreCB = QCheckBox('Restore to a staging folder, then swap it with the documents folder', self)
+        self.stagedRestoreCB.setChecked(self.settings.value('StagedRestore', type=bool))
+        self.deltaTransferCB = QCheckBox('Only transfer the changed blocks of large files over SFTP', self)
+        self.deltaTransferCB.setChecked(self.settings.value('DeltaTransfer', type=bool))
+        self.autoRouteCB = QCheckBox('Connect through the fastest route to the tablet (USB or Wifi)', self)
+        self.autoRouteCB.setChecked(self.settings.value('AutoRoute', type=bool))
         self.tabletDocsDirLE = QLineEdit(self.settings.value('TabletDocumentsDir', type=str), self)
         sshLayout = QGridLayout()
         sshLayout.addWidget(QLabel('Hostname or IP address:'), 0, 0)
@@ -113,6 +204,24 @@ class SettingsDialog(OKCancelDialog):
         sshLayout.addWidget(self.changeSSHPasswordBtn, 2, 1)
         sshLayout.addWidget(QLabel('Documents directory:'), 3, 0)
         sshLayout.addWidget(self.tabletDocsDirLE, 3, 1)
+        sshLayout.addWidget(QLabel('Parallel SFTP transfers:'), 4, 0)
+        sshLayout.addWidget(self.sftpChannelsLE, 4, 1)
+        sshLayout.addWidget(self.incrementalBackupsCB, 5, 0, 1, 2)
+        sshLayout.addWidget(QLabel('Backup transfer method:'), 6, 0)
+        sshLayout.addWidget(self.backupMethodCB, 6, 1)
+        sshLayout.addWidget(self.tarCompressionCB, 7, 0, 1, 2)
+        sshLayout.addWidget(QLabel('Backup format:'), 8, 0)
+        sshLayout.addWidget(self.backupFormatCB, 8, 1)
+        sshLayout.addWidget(QLabel('Exclude from backups:'), 9, 0)
+        sshLayout.addWidget(self.backupExcludesLE, 9, 1)
+        sshLayout.addWidget(self.backupSkipTrashCB, 10, 0, 1, 2)
+        sshLayout.addWidget(self.differentialRestoreCB, 11, 0, 1, 2)
+        sshLayout.addWidget(self.restoreCompareHashesCB, 12, 0, 1, 2)
+        sshLayout.addWidget(QLabel('Restore transfer method:'), 13, 0)
+        sshLayout.addWidget(self.restoreMethodCB, 13, 1)
+        sshLayout.addWidget(self.stagedRestoreCB, 14, 0, 1, 2)
+        sshLayout.addWidget(self.deltaTransferCB, 15, 0, 1, 2)
+        sshLayout.addWidget(self.autoRouteCB, 16, 0, 1, 2)
         sshGroupBox.setLayout(sshLayout)
 
         mainLayout = QVBoxLayout()
@@ -179,6 +288,48 @@ class SettingsDialog(OKCancelDialog):
                                                                           constants.HttpShortTimeoutMax))
             msgBox.exec()
             return
+        #
+        pos = self.downloadConcurrencyLE.cursorPosition()
+        if self.downloadConcurrencyLE.validator().validate(self.downloadConcurrencyLE.text(), pos)[0] != QValidator.Acceptable:
+            msgBox.setText("Number of parallel downloads outside integer range (%d-%d)." % (constants.DownloadConcurrencyMin,
+                                                                                            constants.DownloadConcurrencyMax))
+            msgBox.exec()
+            return
+        #
+        pos = self.treeCacheMaxAgeLE.cursorPosition()
+        if self.treeCacheMaxAgeLE.validator().validate(self.treeCacheMaxAgeLE.text(), pos)[0] != QValidator.Acceptable:
+            msgBox.setText("Folder cache lifetime outside integer range (%d-%d)." % (constants.TreeCacheMaxAgeMin,
+                                                                                     constants.TreeCacheMaxAgeMax))
+            msgBox.exec()
+            return
+        #
+        pos = self.listingConcurrencyLE.cursorPosition()
+        if self.listingConcurrencyLE.validator().validate(self.listingConcurrencyLE.text(), pos)[0] != QValidator.Acceptable:
+            msgBox.setText("Number of parallel folder listings outside integer range (%d-%d)." % (constants.ListingConcurrencyMin,
+                                                                                                  constants.ListingConcurrencyMax))
+            msgBox.exec()
+            return
+        #
+        pos = self.renderProcessesLE.cursorPosition()
+        if self.renderProcessesLE.validator().validate(self.renderProcessesLE.text(), pos)[0] != QValidator.Acceptable:
+            msgBox.setText("Number of PNG rendering processes outside integer range (%d-%d)." % (constants.RenderProcessesMin,
+                                                                                                 constants.RenderProcessesMax))
+            msgBox.exec()
+            return
+        #
+        pos = self.exportCacheMaxMBLE.cursorPosition()
+        if self.exportCacheMaxMBLE.validator().validate(self.exportCacheMaxMBLE.text(), pos)[0] != QValidator.Acceptable:
+            msgBox.setText("Export cache size outside integer range (%d-%d)." % (constants.ExportCacheMaxMBMin,
+                                                                                 constants.ExportCacheMaxMBMax))
+            msgBox.exec()
+            return
+        #
+        pos = self.sftpChannelsLE.cursorPosition()
+        if self.sftpChannelsLE.validator().validate(self.sftpChannelsLE.text(), pos)[0] != QValidator.Acceptable:
+            msgBox.setText("Number of parallel SFTP transfers outside integer range (%d-%d)." % (constants.SFTPChannelsMin,
+                                                                                                 constants.SFTPChannelsMax))
+            msgBox.exec()
+            return
 
         # All validations succeeded
         super().ok()
@@ -212,6 +363,8 @@ class SettingsDialog(OKCancelDialog):
 
         ep = EditPassword(self, self.settings, 'SSH password', 'SSHPassword')
         ep.exec()
+        # Do not keep using connections authenticated with a former password
+        sshpool.sessions.closeAll()
 
 
     def updateSettings(self):
@@ -229,9 +382,53 @@ class SettingsDialog(OKCancelDialog):
                                str(locale.toDouble(self.httpShortTimeoutLE.text())[0]))
         self.settings.setValue('PNGResolution',
                                locale.toUInt(self.pngResolutionLE.text())[0])
+        self.settings.setValue('DownloadConcurrency',
+                               locale.toUInt(self.downloadConcurrencyLE.text())[0])
+        self.settings.setValue('TreeCacheMaxAge',
+                               locale.toUInt(self.treeCacheMaxAgeLE.text())[0])
+        self.settings.setValue('ListingConcurrency',
+                               locale.toUInt(self.listingConcurrencyLE.text())[0])
+        self.settings.setValue('RenderProcesses',
+                               locale.toUInt(self.renderProcessesLE.text())[0])
+        self.settings.setValue('ExportCacheMaxMB',
+                               locale.toUInt(self.exportCacheMaxMBLE.text())[0])
+        self.settings.setValue('PNGRenderer',
+                               self.pngRendererCB.currentData())
+        self.settings.setValue('PrefetchCollections',
+                               self.prefetchCollectionsCB.isChecked())
+        if str(self.sshHostLE.text()) != self.settings.value('TabletHostname', type=str):
+            self.settings.setValue('TabletResolvedIP', '')
         self.settings.setValue('TabletHostname',
                                str(self.sshHostLE.text()))
         self.settings.setValue('SSHUsername',
                                str(self.sshUsernameLE.text()))
         self.settings.setValue('TabletDocumentsDir',
                                str(self.tabletDocsDirLE.text()))
+        self.settings.setValue('SFTPChannels',
+                               locale.toUInt(self.sftpChannelsLE.text())[0])
+        self.settings.setValue('IncrementalBackups',
+                               self.incrementalBackupsCB.isChecked())
+        self.settings.setValue('BackupMethod',
+                               self.backupMethodCB.currentData())
+        self.settings.setValue('TarCompression',
+                               self.tarCompressionCB.isChecked())
+        self.settings.setValue('BackupFormat',
+                               self.backupFormatCB.currentData())
+        self.settings.setValue('BackupExcludePatterns',
+                               str(self.backupExcludesLE.text()))
+        self.settings.setValue('BackupSkipTrash',
+                               self.backupSkipTrashCB.isChecked())
+        self.settings.setValue('DifferentialRestore',
+                               self.differentialRestoreCB.isChecked())
+        self.settings.setValue('RestoreCompareHashes',
+                               self.restoreCompareHashesCB.isChecked())
+        self.settings.setValue('RestoreMethod',
+                               self.restoreMethodCB.currentData())
+        self.settings.setValue('StagedRestore',
+                               self.stagedRestoreCB.isChecked())
+        self.settings.setValue('DeltaTransfer',
+                               self.deltaTransferCB.isChecked())
+        self.settings.setValue('AutoRoute',
+                               self.autoRouteCB.isChecked())
+        # Addresses may have changed
+        routes.invalidate(self.settings)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Parallel SFTP transfers over several channels of one SSH connection"""
+
+
+import threading
+import concurrent.futures
+
+
+class SftpPool():
+    """Runs SFTP operations on a pool of threads, each with its own channel
+
+    Channels are opened on the SSH connection `ssh` when a thread first
+    needs one, so that round trips of up to `nChannels` transfers overlap.
+    Use as a context manager: leaving it waits for the pending operations
+    and closes the channels.
+    """
+
+    def __init__(self, ssh, nChannels):
+
+        self._ssh = ssh
+        self._local = threading.local()
+        self._channels = []
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=nChannels)
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+    def _sftp(self):
+
+        if not hasattr(self._local, 'sftp'):
+            sftp = self._ssh.open_sftp()
+            with self._lock:
+                self._channels.append(sftp)
+            self._local.sftp = sftp
+        return self._local.sftp
+
+
+    def submit(self, fn, *args):
+        """Schedules fn(sftp, *args) and returns its future"""
+
+        return self._executor.submit(lambda: fn(self._sftp(), *args))
+
+
+    def get(self, remotePath, localPath):
+
+        return self.submit(lambda sftp: sftp.get(remotePath, localPath))
+
+
+    def put(self, localPath, remotePath):
+
+        return self.submit(lambda sftp: sftp.put(localPath, remotePath))
+
+
+    def close(self):
+
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for sftp in self._channels:
+                sftp.close()
+            self._channels = []
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Authenticated SSH connections kept open between operations"""
+
+
+import time
+import socket
+import atexit
+import threading
+import contextlib
+import paramiko
+
+import rmexplorer.constants as constants
+import rmexplorer.routes as routes
+
+
+def connect(settings):
+    """Opens a new SSH connection with parameters from `settings`
+
+    The tablet is reached through the fastest route, see routes.py.
+    """
+
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        ssh.connect(routes.sshHost(settings),
+                    username=settings.value('SSHUsername', type=str),
+                    password=settings.encryptedStrValue('SSHPassword'),
+                    timeout=constants.SSHTimeout,
+                    banner_timeout=constants.SSHTimeout,
+                    allow_agent=False)
+    except OSError:
+        # The tablet could not be reached, unlike with an authentication
+        # error
+        ssh.close()
+        routes.invalidate(settings)
+        raise
+    except Exception:
+        ssh.close()
+        raise
+    ssh.get_transport().set_keepalive(constants.SSHKeepaliveInterval)
+
+    return ssh
+
+
+class _Session():
+
+    def __init__(self, ssh):
+
+        self.ssh = ssh
+        self.users = 0
+        self.lastUsed = time.monotonic()
+
+
+def isAlive(ssh):
+    """Tells if a connection still answers
+
+    A transport can look active long after the tablet went to sleep or left
+    the network, so a channel is opened and closed to check it.
+    """
+
+    transport = ssh.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        transport.open_session(timeout=constants.SSHTimeout).close()
+    except (socket.error, EOFError, paramiko.SSHException):
+        return False
+
+    return True
+
+
+class SessionPool():
+    """Shares SSH connections between operations, by host and username
+
+    A connection is closed after it has not been used for
+    `constants.SSHIdleTimeout` seconds. Several operations can use the same
+    connection at the same time, each through its own channels. Connections
+    are checked before being reused.
+    """
+
+    def __init__(self):
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def acquire(self, settings):
+        """Defines a context manager that gives a connected SSHClient"""
+
+        key = (settings.value('TabletHostname', type=str),
+               settings.value('SSHUsername', type=str))
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and not session.ssh.get_transport().is_active():
+                del self._sessions[key]
+                if session.users == 0:
+                    session.ssh.close()
+                session = None
+            if session is not None:
+                session.users += 1
+        if session is not None and not isAlive(session.ssh):
+            self._release(key, session, drop=True)
+            session = None
+        if session is None:
+            # Connection is made without holding the lock, as it can be slow
+            session = _Session(connect(settings))
+            session.users += 1
+            with self._lock:
+                # Another thread may have connected at the same time. Its
+                # connection is closed when no longer used.
+                former = self._sessions.get(key)
+                if former is not None and former.users == 0:
+                    former.ssh.close()
+                self._sessions[key] = session
+
+        try:
+            yield session.ssh
+        except (socket.timeout, ConnectionError, EOFError, paramiko.SSHException):
+            # The connection may be broken: it is not given to new operations
+            # and is closed once the ones using it are done.
+            self._release(key, session, drop=True)
+            raise
+        except BaseException:
+            self._release(key, session)
+            raise
+        else:
+            self._release(key, session, used=True)
+
+
+    def _release(self, key, session, drop=False, used=False):
+        """Ends the use of a connection by an operation
+
+        If `drop` is True, the connection is removed from the pool. Only a
+        successful use, as told by `used`, delays its expiry.
+        """
+
+        with self._lock:
+            session.users -= 1
+            if used:
+                session.lastUsed = time.monotonic()
+            if drop and self._sessions.get(key) is session:
+                del self._sessions[key]
+            orphaned = self._sessions.get(key) is not session and session.users == 0
+        if orphaned:
+            session.ssh.close()
+        else:
+            timer = threading.Timer(constants.SSHIdleTimeout, self._expire)
+            timer.daemon = True
+            timer.start()
+
+
+    def _expire(self):
+        """Closes the connections that have been idle for too long"""
+
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, session in self._sessions.items()
+                       if session.users == 0
+                       and now - session.lastUsed >= constants.SSHIdleTimeout]
+            sessions = [self._sessions.pop(key) for key in expired]
+        for session in sessions:
+            session.ssh.close()
+
+
+    def closeAll(self):
+        """Closes all the connections
+
+        Connections in use are only closed when released, and are not reused.
+        """
+
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            if session.users == 0:
+                session.ssh.close()
+
+
+sessions = SessionPool()
+atexit.register(sessions.closeAll)
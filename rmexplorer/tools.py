@@ -26,18 +26,24 @@
 
 
 import os
-import io
-import socket
 import functools
 import json
 import contextlib
 import re
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
 import urllib.request
 import requests
-import paramiko
-import wand.image
 
 import rmexplorer.constants as constants
+import rmexplorer.renderers as renderers
+import rmexplorer.archives as archives
+import rmexplorer.sshpool as sshpool
+import rmexplorer.routes as routes
+import rmexplorer.manifest as manifest
 
 
 class UploadError(Exception):
@@ -68,36 +74,78 @@ class Version():
         return self._version > v._version
 
 
+@contextlib.contextmanager
+def openSsh(settings):
+    """Defines a context manager that gives an SSH connection with parameters from `settings`
+
+    Connections are taken from the shared pool, so that successive operations
+    do not connect and authenticate again. Open channels, not the connection
+    itself.
+    """
+
+    with sshpool.sessions.acquire(settings) as ssh:
+        yield ssh
+
+
 @contextlib.contextmanager
 def openSftp(settings):
     """Defines a context manager that opens an SFTP session with parameters from `settings`"""
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    try:
-        ssh.connect(settings.value('TabletHostname', type=str),
-                    username=settings.value('SSHUsername', type=str),
-                    password=settings.encryptedStrValue('SSHPassword'),
-                    timeout=constants.SSHTimeout,
-                    banner_timeout=constants.SSHTimeout,
-                    allow_agent=False)
+    with openSsh(settings) as ssh:
+        sftp = ssh.open_sftp()
         try:
-            sftp = ssh.open_sftp()
             yield sftp
         finally:
             sftp.close()
-    finally:
-        ssh.close()
 
 
-def listDir(dirId, settings):
-    """Obtain from a HTTP request the list of collections and documents of a collection"""
+def runCommand(ssh, command, stdin=None):
+    """Runs a shell command on the tablet
+
+    `ssh` is a connected SSHClient. If given, the bytes `stdin` are sent as
+    the command's standard input. Returns the exit status and the standard
+    output and error as bytes.
+    """
+
+    chanIn, chanOut, chanErr = ssh.exec_command(command,
+                                                timeout=constants.SSHTimeout)
+
+    # The input is written from another thread: a command may produce more
+    # output than the channel buffers before it has read all its input.
+    def sendInput():
+        try:
+            if stdin is not None:
+                chanIn.write(stdin)
+        finally:
+            chanIn.channel.shutdown_write()
+    sender = threading.Thread(target=sendInput, daemon=True)
+    sender.start()
+    out = chanOut.read()
+    sender.join()
+    err = chanErr.read()
+
+    return chanOut.channel.recv_exit_status(), out, err
 
-    url = settings.value('listFolderURL', type=str) % dirId
-    res = urllib.request.urlopen(url)
-    data = res.read().decode(constants.HttpJsonEncoding)
 
-    data = json.loads(data)
+def fetchDir(dirId, settings):
+    """Obtain from a HTTP request the raw list of elements of a collection"""
+
+    url = routes.url(settings, 'listFolderURL') % dirId
+    try:
+        with urllib.request.urlopen(url,
+                                    timeout=settings.value('HTTPShortTimeout', type=float)) as res:
+            data = res.read().decode(constants.HttpJsonEncoding)
+    except OSError as e:
+        # The route may have changed, e.g. the USB cable was unplugged
+        if routes.isRouteFailure(e):
+            routes.invalidate(settings)
+        raise
+
+    return json.loads(data)
+
+
+def parseDir(data):
+    """Splits the raw list of elements of a collection into collections and documents"""
 
     collections = []
     docs = []
@@ -115,28 +163,110 @@ def listDir(dirId, settings):
     return collections, docs
 
 
-def downloadFile(fid, basePath, destRelPath, mode, settings):
+def listDir(dirId, settings):
+    """Obtain from a HTTP request the list of collections and documents of a collection"""
+
+    return parseDir(fetchDir(dirId, settings))
+
+
+def docStamp(elem):
+    """Returns a string identifying the revision of an element listed by the tablet
+
+    `elem` is a document or collection entry of the JSON list returned by the
+    list folder URL. Returns None if the entry gives no revision information.
+    """
+
+    if 'Version' not in elem and 'ModifiedClient' not in elem:
+        return None
+
+    return '%s/%s' % (elem.get('Version', ''), elem.get('ModifiedClient', ''))
+
+
+def exportPath(basePath, destRelPath, mode):
+    """Returns the path of the file written when exporting a document"""
 
     destPath = os.path.join(basePath, destRelPath)
     if mode == 'png':
         # We rewrite the path to add an intermediate folder with the visible name:
         parts = os.path.split(destPath)
         destPath = os.path.join(parts[0], parts[1][:-4] + '_pages', parts[1])
-    parts = os.path.split(destPath)
-    url = settings.value('downloadURL', type=str) % fid
-    if not os.path.isdir(parts[0]):
-        os.makedirs(parts[0])
-    socket.setdefaulttimeout(settings.value('HTTPTimeout', type=int))
-    data = urllib.request.urlopen(url).read() # PDF data
-    socket.setdefaulttimeout(settings.value('HTTPShortTimeout', type=float))
+    return destPath
+
+
+def fetchPdf(fid, destPath, settings, progressCallback=None):
+    """Streams the PDF export of a document to `destPath`
+
+    Data is written in chunks to a ".part" file that is renamed to `destPath`
+    once complete, so that an interrupted download never leaves a truncated
+    file under the final name.  If given, `progressCallback` is called after
+    each chunk with the number of bytes received and the total size (0 if the
+    server did not send a Content-Length).
+    """
+
+    url = routes.url(settings, 'downloadURL') % fid
+    partPath = destPath + '.part'
+    # The timeout is passed explicitly rather than through
+    # socket.setdefaulttimeout() since several downloads may run in parallel.
+    try:
+        res = urllib.request.urlopen(url,
+                                     timeout=settings.value('HTTPTimeout', type=int))
+    except OSError as e:
+        if routes.isRouteFailure(e):
+            routes.invalidate(settings)
+        raise
+    with res:
+        total = int(res.headers.get('Content-Length') or 0)
+        received = 0
+        try:
+            with open(partPath, 'wb') as f:
+                while True:
+                    chunk = res.read(constants.HttpChunkSize)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progressCallback is not None:
+                        progressCallback(received, total)
+            os.replace(partPath, destPath)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(partPath)
+            raise
+
+
+def copyFile(src, dest):
+    """Copies a file, writing it under its final name only once complete"""
+
+    partPath = dest + '.part'
+    try:
+        shutil.copyfile(src, partPath)
+        os.replace(partPath, dest)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partPath)
+        raise
+
+
+def downloadFile(fid, basePath, destRelPath, mode, settings, progressCallback=None):
+    """Downloads a document from the tablet as a PDF or a stack of PNG files"""
+
+    destPath = exportPath(basePath, destRelPath, mode)
+    os.makedirs(os.path.split(destPath)[0], exist_ok=True)
     if mode == 'pdf':
-        with open(destPath, 'bw') as f:
-            f.write(data)
+        fetchPdf(fid, destPath, settings, progressCallback)
     else: # mode = png
-        with wand.image.Image(file=io.BytesIO(data),
-                              resolution=settings.value('PNGResolution', type=int)) as img:
-            with img.convert('png') as converted:
-                converted.save(filename=destPath)
+        # The PDF only transits through a temporary file, read back by the
+        # renderer, instead of being held in memory.
+        fd, pdfPath = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            fetchPdf(fid, pdfPath, settings, progressCallback)
+            renderers.renderPng(pdfPath, destPath,
+                                settings.value('PNGResolution', type=int),
+                                settings.value('PNGRenderer', type=str))
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(pdfPath)
 
 
 def uploadFile(path, settings):
@@ -147,24 +277,46 @@ def uploadFile(path, settings):
     basename, ext = os.path.splitext(filename)
 
     with open(path, 'rb') as f:
-        req = requests.post(settings.value('uploadURL', type=str),
-                            files={'file': f},
-                            timeout=settings.value('HTTPTimeout', type=int))
+        try:
+            req = requests.post(routes.url(settings, 'uploadURL'),
+                                files={'file': f},
+                                timeout=settings.value('HTTPTimeout', type=int))
+        except requests.ConnectionError:
+            routes.invalidate(settings)
+            raise
         status = req.status_code
         if status not in successful_states:
             raise UploadError('Server responded with status code %d and message: "%s"' % (status, req.text))
 
 
 def isValidBackupDir(folder):
-    """Checks if a folder looks like a backup by looking at the structure of filenames"""
+    """Checks if a folder looks like a backup by looking at the structure of filenames
 
-    filenames = os.listdir(folder)
+    `folder` can also be a backup archive.
+    """
+
+    if os.path.isfile(folder):
+        if archives.archiveFormat(folder) is None:
+            return (False, 'File "%s" is not a supported backup archive.' % folder)
+        try:
+            # The index of recent archives avoids reading them whole
+            index = manifest.Index.load(folder)
+            if index is not None:
+                filenames = sorted({entry.path.split('/')[0] for entry in index.entries})
+            else:
+                filenames = archives.topLevelNames(folder)
+        except (ValueError, OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            return (False, 'Cannot read archive: %s' % e)
+    else:
+        filenames = os.listdir(folder)
 
     if len(filenames) == 0:
         return (False, 'Folder is empty.')
 
     regexp = '^[0-9a-f]{8}-(?:[0-9a-f]{4}-){3}[0-9a-f]{12}(\.[a-z0-9]+)*$'
     for filename in filenames:
+        if filename == constants.BackupMetaDirname:
+            continue
         m = re.match(regexp, filename)
         if m is None:
             return (False, 'Folder contains file or folder "%s" that does not seem to be part of a reMarkable document according its name.' % filename)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Persistent cache of the collection listings of the tablet"""
+
+
+import os
+import time
+import json
+import sqlite3
+import contextlib
+
+from PyQt5.QtCore import QStandardPaths
+
+import rmexplorer.constants as constants
+import rmexplorer.tools as tools
+
+
+class TreeCache():
+    """Stores in a SQLite database the raw listing of each collection
+
+    Listings are keyed by the list folder URL template and the collection ID,
+    so that changing the URL in the settings does not show the contents of
+    another tablet.  A new connection is opened for each operation, which
+    makes instances usable from any thread.
+    """
+
+    def __init__(self, path=None):
+
+        if path is None:
+            folder = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, constants.TreeCacheFilename)
+        self._path = path
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS listings ('
+                         'source TEXT NOT NULL, '
+                         'id TEXT NOT NULL, '
+                         'data TEXT NOT NULL, '
+                         'fetched REAL NOT NULL, '
+                         'PRIMARY KEY (source, id))')
+
+
+    @contextlib.contextmanager
+    def _connect(self):
+
+        with contextlib.closing(sqlite3.connect(self._path,
+                                                timeout=constants.SQLiteTimeout)) as conn:
+            with conn:
+                yield conn
+
+
+    def get(self, dirId, settings, maxAge=None):
+        """Returns the cached listing of a collection, or None
+
+        Listings older than `maxAge` seconds are ignored.  If `maxAge` is
+        None, the listing is returned whatever its age.
+        """
+
+        source = settings.value('listFolderURL', type=str)
+        with self._connect() as conn:
+            row = conn.execute('SELECT data, fetched FROM listings WHERE source = ? AND id = ?',
+                               (source, dirId)).fetchone()
+        if row is None:
+            return None
+        data, fetched = row
+        if maxAge is not None and time.time() - fetched > maxAge:
+            return None
+        return json.loads(data)
+
+
+    def put(self, dirId, settings, data):
+        """Stores the listing of a collection
+
+        Cached listings of the child collections that were modified or
+        removed since the previous listing are invalidated.
+        """
+
+        source = settings.value('listFolderURL', type=str)
+        with self._connect() as conn:
+            row = conn.execute('SELECT data FROM listings WHERE source = ? AND id = ?',
+                               (source, dirId)).fetchone()
+            if row is not None:
+                newStamps = {elem['ID']: tools.docStamp(elem) for elem in data
+                             if elem['Type'] == 'CollectionType'}
+                for elem in json.loads(row[0]):
+                    if elem['Type'] != 'CollectionType':
+                        continue
+                    # Collections without revision information are always
+                    # listed again
+                    newStamp = newStamps.get(elem['ID'])
+                    if newStamp is None or newStamp != tools.docStamp(elem):
+                        conn.execute('DELETE FROM listings WHERE source = ? AND id = ?',
+                                     (source, elem['ID']))
+            conn.execute('INSERT OR REPLACE INTO listings (source, id, data, fetched) VALUES (?, ?, ?, ?)',
+                         (source, dirId, json.dumps(data), time.time()))
+
+
+    def invalidate(self, dirId=None):
+        """Removes a listing from the cache, or all of them if `dirId` is None"""
+
+        with self._connect() as conn:
+            if dirId is None:
+                conn.execute('DELETE FROM listings')
+            else:
+                conn.execute('DELETE FROM listings WHERE id = ?', (dirId,))
+
+
+    def listDir(self, dirId, settings, maxAge=None):
+        """Returns the raw listing of a collection, from the cache if possible
+
+        See get() for the meaning of `maxAge`.  Use 0 to force a request to
+        the tablet.
+        """
+
+        data = None
+        if maxAge != 0:
+            data = self.get(dirId, settings, maxAge)
+        if data is None:
+            data = tools.fetchDir(dirId, settings)
+            self.put(dirId, settings, data)
+        return data
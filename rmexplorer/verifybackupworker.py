@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# This file is part of the pyrmexplorer software that allows exploring
+# and downloading content stored on Remarkable tablets.
+#
+# Copyright 2019 Nicolas Bruot (https://www.bruot.org/hp/)
+#
+#
+# pyrmexplorer is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pyrmexplorer is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyrmexplorer.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Qt worker that checks a backup against its manifest and the tablet"""
+
+
+import os
+import socket
+import threading
+import concurrent.futures
+import paramiko
+
+from PyQt5.QtCore import QObject
+# Renaming below is to prepare for switch from PyQt5 to PySide2 when it will be
+# mature enough.
+from PyQt5.QtCore import pyqtSignal as Signal
+
+import rmexplorer.constants as constants
+import rmexplorer.tools as tools
+import rmexplorer.inventory as inventory
+import rmexplorer.archives as archives
+import rmexplorer.manifest as manifest
+from rmexplorer.settings import Settings
+
+
+class VerifyBackupWorker(QObject):
+
+    notifyProgress = Signal(int)
+    notifyNSteps = Signal(int)
+    report = Signal(str)
+    error = Signal(str)
+    finished = Signal()
+
+
+    def __init__(self, backupPath, masterKey):
+        """`backupPath` is a backup folder or a backup archive"""
+
+        super().__init__()
+
+        self._settings = Settings(masterKey)
+        self._backupPath = backupPath
+        self._count = 0
+        self._countLock = threading.Lock()
+
+
+    def _step(self):
+        """Counts one more element as processed"""
+
+        with self._countLock:
+            self._count += 1
+            self.notifyProgress.emit(self._count)
+
+
+    def _hashFile(self, path):
+
+        with open(path, 'rb') as f:
+            hashingFile = manifest.HashingFile(f)
+            while hashingFile.read(constants.SSHChunkSize):
+                pass
+        self._step()
+
+        return hashingFile.size, hashingFile.hexdigest()
+
+
+    def _localHashes(self):
+        """Returns the size and hash of each file of the backup, by path"""
+
+        if os.path.isfile(self._backupPath):
+            # Archives are read in a single pass
+            hashes = {}
+            for entry, fileObj in archives.iterFiles(self._backupPath):
+                if not manifest.isMetadata(entry.path):
+                    hashingFile = manifest.HashingFile(fileObj)
+                    while hashingFile.read(constants.SSHChunkSize):
+                        pass
+                    hashes[entry.path] = (hashingFile.size, hashingFile.hexdigest())
+                    self._step()
+            return hashes
+
+        paths = [entry.path for entry in inventory.localInventory(self._backupPath)
+                 if not entry.isDir and not manifest.isMetadata(entry.path)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=constants.VerifyConcurrency) as executor:
+            results = executor.map(lambda path: self._hashFile(os.path.join(self._backupPath,
+                                                                            *path.split('/'))),
+                                   paths)
+            return dict(zip(paths, results))
+
+
+    def _remoteReport(self, backupManifest):
+        """Compares the files of the backup with the ones on the tablet"""
+
+        root = self._settings.value('TabletDocumentsDir', type=str)
+        with tools.openSsh(self._settings) as ssh:
+            remoteHashes = inventory.remoteHashes(ssh, root,
+                                                  sorted(backupManifest.files))
+        self._step()
+        changed = [path for path, (_, digest) in backupManifest.files.items()
+                   if path in remoteHashes and remoteHashes[path] != digest]
+        missing = [path for path in backupManifest.files
+                   if path not in remoteHashes]
+
+        lines = []
+        if not changed and not missing:
+            lines.append('All files of the backup are identical on the tablet.')
+        else:
+            if changed:
+                lines.append('%d file(s) changed on the tablet since the backup.' % len(changed))
+            if missing:
+                lines.append('%d file(s) of the backup not found on the tablet.' % len(missing))
+
+        return lines
+
+
+    def start(self):
+
+        try:
+            backupManifest = manifest.Manifest.load(self._backupPath)
+            if backupManifest is None:
+                raise Exception('This backup has no manifest. Only backups made by this version of %s or later can be verified.' % constants.AppName)
+            self.notifyNSteps.emit(len(backupManifest.files) + 1)
+
+            localHashes = self._localHashes()
+            missing = sorted(set(backupManifest.files) - set(localHashes))
+            extra = sorted(set(localHashes) - set(backupManifest.files))
+            corrupted = sorted(path for path in set(localHashes) & set(backupManifest.files)
+                               if localHashes[path] != backupManifest.files[path])
+
+            lines = []
+            if not missing and not extra and not corrupted:
+                lines.append('Backup is intact: %d file(s) match the manifest.' % len(localHashes))
+            else:
+                lines.append('Backup is damaged:')
+                problems = (['Missing: %s' % path for path in missing]
+                            + ['Corrupted: %s' % path for path in corrupted]
+                            + ['Not in manifest: %s' % path for path in extra])
+                lines += problems[:constants.VerifyMaxReportedFiles]
+                if len(problems) > constants.VerifyMaxReportedFiles:
+                    lines.append('... and %d more.' % (len(problems) - constants.VerifyMaxReportedFiles))
+
+            try:
+                lines += self._remoteReport(backupManifest)
+            except socket.timeout:
+                lines.append('Could not compare with the tablet: SSH timeout.')
+            except socket.error:
+                lines.append('Could not compare with the tablet: socket error. Check that tablet is turned on, Wifi is enabled and that the hostname setting is correct.')
+            except paramiko.SSHException as e:
+                lines.append('Could not compare with the tablet: SSH error: %s' % e)
+
+            self.report.emit('\n'.join(lines))
+        except Exception as e:
+            self.error.emit(str(e))
+
+        self.finished.emit()